@@ -0,0 +1,90 @@
+import datetime
+import functools
+
+import numpy as np
+import pytz
+
+MINUTES_PER_DAY = 24 * 60
+WINDOW_HORIZON_DAYS = 400  # Windows are recomputed after this, so every DST change in between is precomputed
+
+
+@functools.lru_cache(maxsize=1024)
+def get_timezone(name: str):
+    """`pytz.timezone()` memoized per name. Raises `pytz.UnknownTimeZoneError` for unknown names."""
+    return pytz.timezone(name)
+
+
+def validate_timezone(name: str):
+    """Returns the canonical zone name for what the user typed (e.g. "asia/kolkata" -> "Asia/Kolkata"), or None."""
+    try:
+        return get_timezone((name or "").strip()).zone
+    except (pytz.UnknownTimeZoneError, AttributeError, ValueError):
+        return None
+
+
+def parse_hour(text: str):
+    """Parses an onboarding hour answer (0-24), or returns None."""
+    try:
+        hour = int(str(text).strip())
+    except ValueError:
+        return None
+    return hour if 0 <= hour <= 24 else None
+
+
+def _offset_changes(tz, start: datetime.datetime, end: datetime.datetime) -> list:
+    # pytz keeps each zone's UTC transition table; fixed-offset zones have none
+    changes = []
+    for naive in getattr(tz, "_utc_transition_times", None) or []:
+        moment = naive.replace(tzinfo=datetime.timezone.utc)
+        if start < moment < end:
+            changes.append(moment)
+    return changes
+
+
+def utc_windows(tz_name: str, start_hour: int, end_hour: int, now: datetime.datetime,
+                horizon_days: int = WINDOW_HORIZON_DAYS) -> dict:
+    """
+    Converts local active hours [start_hour, end_hour) into UTC minute-of-day windows.
+
+    Returns the user-doc fields `active_windows` (one {"from", "start", "end"} segment per UTC
+    offset the zone uses between `now` and the horizon, i.e. DST changes are precomputed) and
+    `active_windows_until` (when they must be recomputed). As with the local hours, start >= end
+    means the window wraps past midnight and start == end means all day.
+    """
+    tz = get_timezone(tz_name)
+    until = now + datetime.timedelta(days=horizon_days)
+    segments = []
+    for begins in [now] + _offset_changes(tz, now, until):
+        offset = int(begins.astimezone(tz).utcoffset().total_seconds() // 60)
+        segments.append({
+            "from": begins,
+            "start": (int(start_hour) * 60 - offset) % MINUTES_PER_DAY,
+            "end": (int(end_hour) * 60 - offset) % MINUTES_PER_DAY,
+        })
+    return {"active_windows": segments, "active_windows_until": until}
+
+
+def window_at(segments, until, now: datetime.datetime):
+    """The (start, end) UTC minute window in force at `now`, or None if missing or expired."""
+    if not segments or until is None or now >= until:
+        return None
+    current = None
+    for segment in segments:
+        if segment["from"] > now:
+            break
+        current = segment
+    return None if current is None else (current["start"], current["end"])
+
+
+def minute_of_day(now: datetime.datetime) -> int:
+    now = now.astimezone(datetime.timezone.utc)
+    return now.hour * 60 + now.minute
+
+
+def active_mask(starts, ends, minute: int) -> np.ndarray:
+    """Vectorized "is `minute` (UTC minute of day) inside [start, end)" over many users' windows."""
+    starts = np.asarray(starts, dtype=np.int16)
+    ends = np.asarray(ends, dtype=np.int16)
+    inside = (starts <= minute) & (minute < ends)
+    wrapped = (minute >= starts) | (minute < ends)
+    return np.where(starts < ends, inside, wrapped)
@@ -0,0 +1,126 @@
+"""
+Concurrent webhook throughput: blocking Firestore client vs non-blocking data layer.
+
+Each simulated webhook does the Firestore work of one normal chat turn (user doc read,
+history read, a few writes) plus an awaited model call. The "blocking" variant issues the
+Firestore calls the way the old synchronous `firestore.Client` did — straight on the event
+loop — while the "async" variant awaits them like `firestore.AsyncClient`.
+
+Usage:
+    python benchmarks/bench_firestore_concurrency.py                 # simulated latencies
+    python benchmarks/bench_firestore_concurrency.py --concurrency 50 --requests 500
+    FIRESTORE_EMULATOR_HOST=localhost:8681 python benchmarks/bench_firestore_concurrency.py --emulator
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# --- Simulated backends ---
+
+def make_simulated_turn(blocking: bool, calls: int, firestore_ms: float, model_ms: float):
+    async def firestore_call():
+        if blocking:
+            time.sleep(firestore_ms / 1000.0)  # What a sync client does to the event loop
+        else:
+            await asyncio.sleep(firestore_ms / 1000.0)
+
+    async def turn(i: int):
+        await firestore_call()                      # user doc read
+        await firestore_call()                      # history read
+        await asyncio.sleep(model_ms / 1000.0)      # Gemini reply (already async)
+        for _ in range(max(0, calls - 2)):          # history / memory / profile writes
+            await firestore_call()
+
+    return turn
+
+
+# --- Emulator backends ---
+
+def make_emulator_turn(blocking: bool, calls: int, model_ms: float):
+    from google.cloud import firestore
+
+    clients = {}
+
+    async def turn(i: int):
+        # Created lazily so the async client binds to the benchmark's event loop
+        if "client" not in clients:
+            clients["client"] = firestore.Client(project="bench-project") if blocking else firestore.AsyncClient(project="bench-project")
+        ref = clients["client"].collection("bench_users").document(f"user-{i % 100}")
+        if blocking:
+            ref.get()
+            ref.collection("recent_chat_history").limit(25).get()
+        else:
+            await ref.get()
+            await ref.collection("recent_chat_history").limit(25).get()
+        await asyncio.sleep(model_ms / 1000.0)
+        for n in range(max(0, calls - 2)):
+            data = {"n": n, "waiting_for_reply": False}
+            if blocking:
+                ref.set(data, merge=True)
+            else:
+                await ref.set(data, merge=True)
+
+    return turn
+
+
+async def run(turn, concurrency: int, total: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await turn(i)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    return elapsed, latencies
+
+
+def report(label: str, elapsed: float, latencies: list, total: int):
+    print(
+        f"{label:<10} {total / elapsed:8.1f} req/s   "
+        f"p50 {statistics.median(latencies) * 1000:8.1f} ms   "
+        f"p95 {_percentile(latencies, 95) * 1000:8.1f} ms   "
+        f"wall {elapsed:6.2f} s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent webhooks in flight")
+    parser.add_argument("--requests", type=int, default=200, help="total webhooks to run")
+    parser.add_argument("--calls", type=int, default=6, help="Firestore calls per webhook")
+    parser.add_argument("--firestore-ms", type=float, default=15.0, help="simulated latency per Firestore call")
+    parser.add_argument("--model-ms", type=float, default=300.0, help="simulated Gemini reply latency")
+    parser.add_argument("--emulator", action="store_true", help="use real clients against FIRESTORE_EMULATOR_HOST")
+    args = parser.parse_args()
+
+    print(
+        f"{args.requests} webhooks, concurrency {args.concurrency}, "
+        f"{args.calls} Firestore calls each, model {args.model_ms:.0f} ms"
+        + ("" if args.emulator else f", Firestore {args.firestore_ms:.0f} ms (simulated)")
+    )
+    for label, blocking in (("blocking", True), ("async", False)):
+        if args.emulator:
+            turn = make_emulator_turn(blocking, args.calls, args.model_ms)
+        else:
+            turn = make_simulated_turn(blocking, args.calls, args.firestore_ms, args.model_ms)
+        elapsed, latencies = asyncio.run(run(turn, args.concurrency, args.requests))
+        report(label, elapsed, latencies, args.requests)
+
+
+if __name__ == "__main__":
+    main()
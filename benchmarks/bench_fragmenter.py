@@ -0,0 +1,101 @@
+"""
+Fragmentation planner microbenchmark and corpus regression check.
+
+`fragmenter_corpus.json` holds representative replies together with the fragments and
+delays the original in-line `deliver_message()` produced for them (same settings, seeded
+RNG), and the fragments streamed delivery sends for them (`stream_expected`: the reply fed
+to `StreamFragmenter` in STREAM_CHUNK_CHARS pieces, formatted like `deliver_stream()`).
+`--check` replays every case through both and fails on any difference; it also reports how
+many cases stream exactly like `plan_delivery()` (the planner sees the whole reply, so
+length-dependent merging can differ). The default mode times the planner over the corpus.
+
+Usage:
+    python benchmarks/bench_fragmenter.py                    # timing
+    python benchmarks/bench_fragmenter.py --iterations 5000
+    python benchmarks/bench_fragmenter.py --check            # regression check (exit 1 on mismatch)
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fragmenter import FragmentSettings, StreamFragmenter, format_fragment, plan_delivery  # noqa: E402
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fragmenter_corpus.json")
+STREAM_CHUNK_CHARS = 8  # Roughly a streamed model chunk's worth of text
+
+
+def load_corpus(path: str):
+    with open(path, encoding="utf-8") as f:
+        corpus = json.load(f)
+    return FragmentSettings(**corpus["settings"]), corpus["cases"]
+
+
+def stream_fragments(text: str, settings: FragmentSettings) -> list:
+    fragmenter = StreamFragmenter(settings)
+    fragments = []
+    for start in range(0, len(text), STREAM_CHUNK_CHARS):
+        fragments.extend(fragmenter.feed(text[start:start + STREAM_CHUNK_CHARS]))
+    last = fragmenter.finish()
+    if last:
+        fragments.append(last)
+    return [format_fragment(fragment, index == len(fragments) - 1) for index, fragment in enumerate(fragments)]
+
+
+def check(settings: FragmentSettings, cases: list) -> int:
+    failures = 0
+    same_as_planned = 0
+    for index, case in enumerate(cases):
+        got = [[text, round(delay, 6)] for text, delay in plan_delivery(case["text"], settings, random.Random(case["seed"]))]
+        streamed = stream_fragments(case["text"], settings)
+        same_as_planned += streamed == [text for text, _ in got]
+        for name, expected, actual in (("planned", case["expected"], got), ("streamed", case["stream_expected"], streamed)):
+            if actual != expected:
+                failures += 1
+                print(f"case {index}: {name} MISMATCH")
+                print(f"  text:     {case['text'][:80]!r}")
+                print(f"  expected: {expected}")
+                print(f"  got:      {actual}")
+    print(f"{2 * len(cases) - failures}/{2 * len(cases)} planned/streamed results match")
+    print(f"{same_as_planned}/{len(cases)} cases stream exactly as planned")
+    return 1 if failures else 0
+
+
+def bench(settings: FragmentSettings, cases: list, iterations: int):
+    texts = [case["text"] for case in cases]
+    rng = random.Random(0)
+    per_pass = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        for text in texts:
+            plan_delivery(text, settings, rng)
+        per_pass.append(time.perf_counter() - start)
+
+    per_reply_us = statistics.median(per_pass) / len(texts) * 1_000_000
+    print(
+        f"{len(texts)} replies x {iterations} passes   "
+        f"median {per_reply_us:7.2f} us/reply   "
+        f"{len(texts) / statistics.median(per_pass):10.0f} replies/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=CORPUS_PATH, help="path to the corpus JSON")
+    parser.add_argument("--iterations", type=int, default=2000, help="timed passes over the corpus")
+    parser.add_argument("--check", action="store_true", help="compare against the corpus goldens instead of timing")
+    args = parser.parse_args()
+
+    settings, cases = load_corpus(args.corpus)
+    if args.check:
+        sys.exit(check(settings, cases))
+    bench(settings, cases, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+/rem context assembly: every journal in one blob vs BM25 top-k passages, as the corpus grows.
+
+For each corpus size the script generates synthetic journals (monthly / weekly / daily mix),
+then reports for both approaches how long assembling the prompt context takes, how many
+tokens it sends to Gemini, and an estimated prefill time for those tokens (`--prefill-ms`
+per 1k input tokens). The BM25 index is built once per corpus (as the journal jobs do
+incrementally), so its build time is reported separately.
+
+Usage:
+    python benchmarks/bench_rem_retrieval.py
+    python benchmarks/bench_rem_retrieval.py --sizes 10 100 1000 --queries 200 --budget 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from retrieval import BM25Index, estimate_tokens  # noqa: E402
+
+TOPICS = [
+    "hiking trip to the mountains with Priya", "job interview at the design studio", "mom's birthday dinner",
+    "learning guitar chords", "marathon training and knee pain", "moving into the new apartment",
+    "exam stress before finals", "adopting a cat named Mochi", "weekend road trip to the coast",
+    "started reading Dune", "argument with a roommate about chores", "promotion at work",
+    "cooking pasta from scratch", "planning a trip to Japan", "visiting the dentist", "volunteering at the shelter",
+]
+FILLER = (
+    "They mentioned feeling {mood} about it and said it mattered a lot to them. "
+    "They asked me to remember the details and check in later about how it went. "
+)
+MOODS = ["excited", "nervous", "tired", "proud", "anxious", "happy", "overwhelmed", "hopeful"]
+QUERIES = [
+    "when did I go hiking", "what happened at my job interview", "what is my cat called", "how is my knee",
+    "what book was I reading", "where did I want to travel", "what did we do for mom's birthday", "remember the promotion",
+]
+
+
+def make_journal(rng: random.Random, kind: str, name: str) -> str:
+    entries = {"Monthly Journal": 8, "Weekly Journal": 5, "Daily Journal": 3}[kind]
+    lines = []
+    for _ in range(entries):
+        lines.append(f"{name}: {rng.choice(TOPICS).capitalize()}. " + FILLER.format(mood=rng.choice(MOODS)))
+    return "\n\n".join(lines)
+
+
+def make_corpus(size: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        kind = ("Monthly Journal", "Weekly Journal", "Daily Journal")[i % 3]
+        name = f"{kind.split()[0]}-{i}"
+        corpus.append((kind, name, make_journal(rng, kind, name)))
+    return corpus
+
+
+def blob_context(corpus: list) -> str:
+    # What /rem used to send: every journal, formatted, in one string
+    return "\n".join(f"--- {kind}: {name} ---\n{text}\n" for kind, name, text in corpus)
+
+
+def bm25_context(index: BM25Index, query: str, k: int, budget: int) -> str:
+    return "\n".join(f"--- {label} ---\n{text}\n" for label, text, _ in index.search(query, k=k, token_budget=budget))
+
+
+def time_queries(fn, queries: list) -> tuple:
+    timings = []
+    tokens = []
+    for query in queries:
+        start = time.perf_counter()
+        context = fn(query)
+        timings.append(time.perf_counter() - start)
+        tokens.append(estimate_tokens(context))
+    return statistics.median(timings) * 1000, statistics.mean(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200, 1000], help="journals per user")
+    parser.add_argument("--queries", type=int, default=100, help="queries per corpus size")
+    parser.add_argument("--top-k", type=int, default=8, help="BM25 passages per query")
+    parser.add_argument("--budget", type=int, default=2000, help="BM25 context token budget")
+    parser.add_argument("--prefill-ms", type=float, default=25.0, help="estimated model prefill cost per 1k input tokens")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    queries = [rng.choice(QUERIES) for _ in range(args.queries)]
+    print(f"{'journals':>8}  {'approach':<6} {'assemble':>12} {'ctx tokens':>11} {'est. prefill':>13}   index build")
+    for size in args.sizes:
+        corpus = make_corpus(size)
+
+        blob_ms, blob_tokens = time_queries(lambda q: blob_context(corpus), queries)
+
+        start = time.perf_counter()
+        index = BM25Index()
+        for rank, (kind, name, text) in enumerate(reversed(corpus)):
+            index.add_document(f"{kind}/{name}", f"{kind}: {name}", text, rank)
+        index.search("warm up")  # compiles the scoring arrays
+        build_ms = (time.perf_counter() - start) * 1000
+        bm25_ms, bm25_tokens = time_queries(lambda q: bm25_context(index, q, args.top_k, args.budget), queries)
+
+        for label, ms, tokens, extra in (("blob", blob_ms, blob_tokens, ""), ("bm25", bm25_ms, bm25_tokens, f"{build_ms:9.1f} ms ({len(index)} passages)")):
+            print(
+                f"{size:>8}  {label:<6} {ms:9.3f} ms {tokens:>11.0f} {tokens / 1000 * args.prefill_ms:10.0f} ms   {extra}"
+            )
+
+
+if __name__ == "__main__":
+    main()
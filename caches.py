@@ -0,0 +1,404 @@
+import collections
+import datetime
+import hashlib
+import time
+
+
+class ChatHistoryCache:
+    """
+    In-process ring buffer of each user's most recent chat turns.
+
+    - Holds up to `max_messages` messages per user (oldest fall off the ring).
+    - Evicts least-recently-used users when more than `max_users` are cached or
+      the cached text exceeds `max_chars` in total (the memory cap).
+    - Entries older than `ttl` seconds count as misses, so an instance re-reads
+      Firestore periodically and picks up messages written by other instances.
+    - Each entry tracks the history sequence number it expects to be persisted up to;
+      a caller that knows the user's stored `history_seq` gets a miss when it is ahead
+      (another instance wrote messages this one hasn't seen).
+    """
+
+    def __init__(self, max_messages: int = 25, max_users: int = 1000, max_chars: int = 2_000_000, ttl: float = 300.0):
+        self.max_messages = max_messages
+        self.max_users = max_users
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # user_id -> {"messages": deque, "chars": int, "loaded_at": float, "seq": int}
+        self._chars = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, user_id: str, limit: int, seq: int = None):
+        """Returns up to `limit` most recent messages (oldest first), or None on a miss."""
+        entry = self._entries.get(user_id)
+        if entry is None or limit > self.max_messages:
+            self.misses += 1
+            return None
+        behind = seq is not None and entry["seq"] is not None and seq > entry["seq"]
+        if behind or time.monotonic() - entry["loaded_at"] > self.ttl:
+            self.stale += 1
+            self.misses += 1
+            self._drop(user_id)
+            return None
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+        messages = entry["messages"]
+        return list(messages)[-limit:] if limit < len(messages) else list(messages)
+
+    def load(self, user_id: str, messages: list, seq: int = None):
+        """Replaces the user's ring with `messages` (oldest first) freshly read from Firestore, up to `seq`."""
+        self._drop(user_id)
+        ring = collections.deque(maxlen=self.max_messages)
+        entry = {"messages": ring, "chars": 0, "loaded_at": time.monotonic(), "seq": seq}
+        self._entries[user_id] = entry
+        for message in messages:
+            self._push(entry, message)
+        self._evict()
+
+    def append(self, user_id: str, role: str, text: str, timestamp=None):
+        """
+        Write-through for a message that was just persisted. Only users already in
+        the cache are updated; anyone else is loaded from Firestore on their next read.
+        """
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        self._push(entry, {
+            "role": role,
+            "text": text,
+            "timestamp": timestamp or datetime.datetime.now(datetime.timezone.utc),
+        })
+        if entry["seq"] is not None:
+            entry["seq"] += 1  # Every persisted message takes the next sequence number
+        self._entries.move_to_end(user_id)
+        self._evict()
+
+    def invalidate(self, user_id: str):
+        self._drop(user_id)
+
+    def _push(self, entry: dict, message: dict):
+        ring = entry["messages"]
+        if len(ring) == ring.maxlen:
+            dropped = ring[0]
+            entry["chars"] -= len(dropped.get("text") or "")
+            self._chars -= len(dropped.get("text") or "")
+        ring.append(message)
+        entry["chars"] += len(message.get("text") or "")
+        self._chars += len(message.get("text") or "")
+
+    def _drop(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._chars -= entry["chars"]
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_users or self._chars > self.max_chars):
+            user_id = next(iter(self._entries))
+            self._drop(user_id)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "chars": self._chars,
+            "max_users": self.max_users,
+            "max_chars": self.max_chars,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class ModelCache:
+    """
+    Bounded LRU cache of GenerativeModel handles keyed by a hash of their system prompt.
+
+    Users with identical prompts share one handle. `invalidate_user()` drops a user's
+    handle as soon as their profile changes (unless another user still shares it).
+    """
+
+    def __init__(self, max_models: int = 256):
+        self.max_models = max_models
+        self._models = collections.OrderedDict()  # prompt hash -> model
+        self._owners = {}                          # prompt hash -> set of user ids
+        self._user_keys = {}                       # user id -> prompt hash
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key_for(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def get_or_create(self, user_id: str, prompt: str, factory):
+        """Returns the cached model for `prompt`, building it with `factory(prompt)` on a miss."""
+        key = self.key_for(prompt)
+        if self._user_keys.get(user_id) not in (None, key):
+            self.invalidate_user(user_id)
+
+        model = self._models.get(key)
+        if model is not None:
+            self.hits += 1
+            self._models.move_to_end(key)
+        else:
+            self.misses += 1
+            model = factory(prompt)
+            self._models[key] = model
+            while len(self._models) > self.max_models:
+                old_key, _ = self._models.popitem(last=False)
+                for owner in self._owners.pop(old_key, ()):
+                    self._user_keys.pop(owner, None)
+                self.evictions += 1
+
+        self._owners.setdefault(key, set()).add(user_id)
+        self._user_keys[user_id] = key
+        return model
+
+    def invalidate_user(self, user_id: str):
+        key = self._user_keys.pop(user_id, None)
+        if key is None:
+            return
+        owners = self._owners.get(key)
+        if owners is not None:
+            owners.discard(user_id)
+            if not owners:
+                del self._owners[key]
+                self._models.pop(key, None)
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "models": len(self._models),
+            "max_models": self.max_models,
+            "users": len(self._user_keys),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class TTLSet:
+    """
+    Bounded set of recently seen keys that expire after `ttl` seconds.
+    Used to recognise repeated deliveries of the same Telegram update.
+    """
+
+    def __init__(self, ttl: float = 3600.0, max_items: int = 50_000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._seen = collections.OrderedDict()  # key -> expires_at (monotonic)
+
+    def add(self, key) -> bool:
+        """Records `key`. Returns False if it was already present (i.e. a duplicate)."""
+        now = time.monotonic()
+        self._expire(now)
+        if key in self._seen:
+            return False
+        self._seen[key] = now + self.ttl
+        while len(self._seen) > self.max_items:
+            self._seen.popitem(last=False)
+        return True
+
+    def discard(self, key):
+        self._seen.pop(key, None)
+
+    def _expire(self, now: float):
+        # Keys are inserted in time order with the same ttl, so expired ones sit at the front
+        while self._seen:
+            key, expires_at = next(iter(self._seen.items()))
+            if expires_at > now:
+                break
+            self._seen.popitem(last=False)
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class ImagePartCache:
+    """
+    LRU cache of model-ready image parts keyed by Telegram's `file_unique_id`.
+
+    The same photo forwarded or re-sent keeps its `file_unique_id`, so a hit skips both the
+    `getFile` call and the download. Bounded by total image bytes (`max_bytes`) and entries.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, max_items: int = 512):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self._entries = collections.OrderedDict()  # file_unique_id -> (part, size in bytes)
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def get(self, file_unique_id: str):
+        entry = self._entries.get(file_unique_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(file_unique_id)
+        self.hits += 1
+        self.bytes_saved += entry[1]
+        return entry[0]
+
+    def put(self, file_unique_id: str, part, size: int):
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(file_unique_id, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._entries[file_unique_id] = (part, size)
+        self._bytes += size
+        while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_items):
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self._bytes -= old_size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "images": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+class TTLCache:
+    """
+    Bounded LRU mapping whose entries expire `ttl` seconds after they were stored
+    (a per-entry `ttl` may be given to `put()`). Used for grounded search results.
+    """
+
+    def __init__(self, ttl: float = 1800.0, max_items: int = 1000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._entries = collections.OrderedDict()  # key -> (value, expires_at)
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[1] <= time.monotonic():
+            del self._entries[key]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, ttl: float = None):
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
+
+
+class ProfileCache:
+    """
+    Write-through copy of user profile docs (`users/{id}`), so chat turns can skip the
+    profile read.
+
+    - Entries expire `ttl` seconds after they were read from Firestore, so changes made
+      by other instances or the scheduled jobs are picked up.
+    - Writers on this instance merge what they wrote with `update()` (only users already
+      cached; it does not extend the entry's lifetime) or `invalidate()` the user when the
+      stored value is computed server-side.
+    - Least-recently-used users are evicted beyond `max_users`.
+    """
+
+    def __init__(self, ttl: float = 120.0, max_users: int = 5000):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries = collections.OrderedDict()  # user_id -> (profile dict, loaded_at)
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _live(self, user_id: str):
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() - entry[1] > self.ttl:
+            del self._entries[user_id]
+            self.expired += 1
+            return None
+        return entry
+
+    def get(self, user_id: str):
+        """Returns a copy of the cached profile, or None on a miss."""
+        entry = self._live(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return dict(entry[0])
+
+    def peek(self, user_id: str):
+        """Like `get()` but without counting a lookup (used by writers deciding whether to write)."""
+        entry = self._live(user_id)
+        return None if entry is None else dict(entry[0])
+
+    def put(self, user_id: str, profile: dict):
+        self._entries[user_id] = (dict(profile), time.monotonic())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, user_id: str, fields: dict):
+        entry = self._live(user_id)
+        if entry is not None:
+            entry[0].update(fields)
+
+    def invalidate(self, user_id: str):
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
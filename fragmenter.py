@@ -0,0 +1,219 @@
+"""
+Fragmentation planner for the delivery engine.
+
+Pure functions only: no Telegram or network I/O, so the planner can be benchmarked,
+regression-checked and run anywhere. Settings are read from the environment once
+(`FragmentSettings.from_env()`) and passed in explicitly.
+"""
+import math
+import os
+import random
+import re
+from dataclasses import dataclass
+
+# Precompiled patterns (previously rebuilt on every deliver_message call)
+_PARAGRAPH_BREAK = re.compile(r'\n{2,}')
+_CLAUSE = re.compile(r'[^,;.!?—]+[,:;.!?—]?')
+_SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+')
+_STREAM_SENTENCE_END = re.compile(r'[.!?]+["\')\]]*\s+|\n+')
+_STREAM_CLAUSE_END = re.compile(r'[,;:—]\s+')
+
+
+def _env_number(name: str, default, cast):
+    try:
+        return cast(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+@dataclass(frozen=True)
+class FragmentSettings:
+    max_chars: int = 140
+    pause_per_word: float = 0.25
+    min_sleep: float = 0.8
+    max_sleep: float = 3.0
+    stream_max_fragments: int = 7
+    stream_clause_min_chars: int = 40
+
+    @classmethod
+    def from_env(cls) -> "FragmentSettings":
+        """Builds settings from FRAGMENT_MAX_CHARS, PAUSE_PER_WORD, MIN_SLEEP, MAX_SLEEP, STREAM_MAX_FRAGMENTS and STREAM_CLAUSE_MIN_CHARS."""
+        return cls(
+            max_chars=_env_number("FRAGMENT_MAX_CHARS", 140, int),
+            pause_per_word=_env_number("PAUSE_PER_WORD", 0.25, float),
+            min_sleep=_env_number("MIN_SLEEP", 0.8, float),
+            max_sleep=_env_number("MAX_SLEEP", 3.0, float),
+            stream_max_fragments=_env_number("STREAM_MAX_FRAGMENTS", 7, int),
+            stream_clause_min_chars=_env_number("STREAM_CLAUSE_MIN_CHARS", 40, int),
+        )
+
+
+def split_sentences(text: str) -> list:
+    parts = [s.strip() for s in _SENTENCE_BREAK.split(text) if s.strip()]
+    return parts if parts else [text]
+
+
+def split_into_clauses(paragraph: str, max_len: int) -> list:
+    # Find clause-like chunks (keep trailing delimiter if present)
+    chunks = [c.strip() for c in _CLAUSE.findall(paragraph) if c.strip()]
+
+    # Merge extremely short chunks with the next chunk
+    merged = []
+    i = 0
+    while i < len(chunks):
+        cur = chunks[i]
+        if len(cur) < 4 and i + 1 < len(chunks):
+            cur = (cur + " " + chunks[i + 1]).strip()
+            i += 2
+        else:
+            i += 1
+        merged.append(cur)
+
+    # Further split any very long fragments into max_len pieces while preserving words
+    final = []
+    for chunk in merged:
+        if len(chunk) <= max_len:
+            final.append(chunk)
+        else:
+            cur_piece = ""
+            for w in chunk.split():
+                if len(cur_piece) + len(w) + 1 <= max_len:
+                    cur_piece = (cur_piece + " " + w).strip()
+                else:
+                    final.append(cur_piece)
+                    cur_piece = w
+            if cur_piece:
+                final.append(cur_piece)
+    return final
+
+
+def plan_fragments(full_text: str, settings: FragmentSettings) -> list:
+    """
+    Splits a reply into human-like fragments:
+    - short text (<= 120 chars) splits by sentence, falling back to clauses for 2-4 fragments;
+    - medium text (<= 200 chars) splits by clause, at most 6 fragments;
+    - long text splits by clause, at most 7 fragments.
+    Micro-fragments are merged and anything over `settings.max_chars` is chunked by words.
+    """
+    text = (full_text or "").strip()
+    total_len = len(text)
+    paragraphs = [p.strip() for p in _PARAGRAPH_BREAK.split(full_text or "") if p.strip()]
+
+    fragments = []
+    if total_len <= 120:
+        for p in paragraphs:
+            fragments.extend(split_sentences(p))
+        desired_min, desired_max = 2, 4
+        if len(fragments) < desired_min:
+            temp = []
+            for s in fragments:
+                temp.extend(split_into_clauses(s, settings.max_chars))
+            if temp:
+                fragments = temp
+    elif total_len <= 200:
+        for p in paragraphs:
+            fragments.extend(split_into_clauses(p, settings.max_chars))
+        desired_max = 6
+    else:
+        for p in paragraphs:
+            fragments.extend(split_into_clauses(p, settings.max_chars))
+        desired_max = 7
+
+    # Fallback to whole text if nothing produced
+    if not fragments:
+        fragments = [text]
+
+    # If we have more fragments than desired_max, merge into desired_max chunks
+    if len(fragments) > desired_max:
+        group_size = math.ceil(len(fragments) / desired_max)
+        fragments = [" ".join(fragments[i:i + group_size]) for i in range(0, len(fragments), group_size)]
+    return fragments
+
+
+def format_fragment(fragment: str, is_last: bool) -> str:
+    """Adds an ellipsis to mid-stream fragments that don't end with sentence punctuation."""
+    if fragment and fragment[-1] not in ".!?," and not is_last:
+        return fragment + "..."
+    return fragment
+
+
+def fragment_delay(fragment: str, settings: FragmentSettings, rng=random) -> float:
+    """Human-like pause before a fragment: proportional to its words, capped by a random sleep."""
+    return min(settings.pause_per_word * len(fragment.split()), rng.uniform(settings.min_sleep, settings.max_sleep))
+
+
+def plan_delivery(full_text: str, settings: FragmentSettings, rng=random) -> list:
+    """Returns [(outgoing_text, delay_seconds), ...] for a complete reply. Empty fragments are skipped."""
+    fragments = plan_fragments(full_text, settings)
+    plan = []
+    for idx, fragment in enumerate(fragments):
+        if not fragment:
+            continue
+        is_last = (idx == len(fragments) - 1)
+        plan.append((format_fragment(fragment, is_last), fragment_delay(fragment, settings, rng)))
+    return plan
+
+
+def take_stream_fragment(buffer: str, settings: FragmentSettings):
+    """
+    Returns (fragment, rest) for the first complete fragment at the start of a streaming
+    `buffer`, or (None, buffer) if more text is needed. Sentence ends and line/paragraph
+    breaks always complete a fragment; clause punctuation only once the fragment is `stream_clause_min_chars` long;
+    anything longer than `max_chars` is cut at a word boundary. A fragment is only taken
+    once text follows it, so a returned fragment is never the last one of the reply.
+    """
+    max_len = settings.max_chars
+    cut = None
+    # Same sentence/paragraph boundaries as plan_fragments(): even "Ok." is its own fragment
+    match = _STREAM_SENTENCE_END.search(buffer)
+    if match is not None:
+        cut = match.end()
+    for match in _STREAM_CLAUSE_END.finditer(buffer):
+        if cut is not None and match.end() >= cut:
+            break
+        if len(buffer[:match.end()].strip()) >= settings.stream_clause_min_chars:
+            cut = match.end()
+            break
+
+    if cut is not None and len(buffer[:cut].strip()) <= max_len:
+        if not buffer[cut:].strip():
+            return None, buffer
+        return buffer[:cut].strip(), buffer[cut:]
+
+    if len(buffer) > max_len:
+        space = buffer.rfind(" ", 0, max_len + 1)
+        cut = space if space > 0 else max_len
+        if buffer[cut:].strip():
+            return buffer[:cut].strip(), buffer[cut:]
+    return None, buffer
+
+
+class StreamFragmenter:
+    """
+    Incremental counterpart of `plan_fragments()` for a streamed reply: `feed()` each piece of
+    text as it arrives and send the fragments it returns, then send `finish()` (the remainder,
+    the last fragment) once the stream ends. At most `stream_max_fragments` fragments in total.
+    """
+
+    def __init__(self, settings: FragmentSettings):
+        self.settings = settings
+        self.buffer = ""
+        self.emitted = 0
+
+    def feed(self, piece: str) -> list:
+        self.buffer += piece
+        fragments = []
+        # Keep the last slot for the remainder so long replies don't over-fragment
+        while self.emitted < self.settings.stream_max_fragments - 1:
+            fragment, self.buffer = take_stream_fragment(self.buffer, self.settings)
+            if fragment is None:
+                break
+            if fragment:
+                fragments.append(fragment)
+                self.emitted += 1
+        return fragments
+
+    def finish(self):
+        """The last fragment (whatever is left in the buffer), or None."""
+        rest, self.buffer = self.buffer.strip(), ""
+        return rest or None
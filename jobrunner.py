@@ -0,0 +1,212 @@
+import asyncio
+import collections
+import datetime
+import logging
+import time
+import zlib
+
+from metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+SKIPPED = "skipped"  # Returned by a per-user handler that decided the user has nothing to do
+FAILED = "failed"    # Returned by a per-user handler that already logged its own error
+RUN_RETENTION = datetime.timedelta(days=40)  # `expire_at` on run docs and markers (longer than a monthly period)
+
+
+SHARD_KEY_SPACE = 2 ** 32
+
+
+def shard_key(user_id: str) -> int:
+    """Stable hash of a user id (CRC32, identical on every instance and restart), stored on the user doc as `shard_key`."""
+    return zlib.crc32(str(user_id).encode("utf-8"))
+
+
+def shard_of(user_id: str, shard_count: int) -> int:
+    """Shard of a user: shard i of n owns the i-th of n equal `shard_key` ranges (see shard_range)."""
+    return shard_key(user_id) * max(1, int(shard_count)) // SHARD_KEY_SPACE
+
+
+def shard_range(shard_index: int, shard_count: int) -> tuple:
+    """The `shard_key` range [low, high) of a shard, so queries can select its users in Firestore."""
+    shard_count = max(1, int(shard_count))
+    low = -(-shard_index * SHARD_KEY_SPACE // shard_count)
+    high = -(-(shard_index + 1) * SHARD_KEY_SPACE // shard_count)
+    return low, high
+
+
+async def shard_users(users, shard_index: int = 0, shard_count: int = 1):
+    """Yields only the users from `users` that belong to shard `shard_index` of `shard_count`."""
+    async for user_doc in users:
+        if shard_count <= 1 or shard_of(user_doc.id, shard_count) == shard_index:
+            yield user_doc
+
+
+async def run_per_user(job: str, users, handler, concurrency: int = 8, deadline: float = None) -> dict:
+    """
+    Runs `await handler(user_doc)` for every user from the async iterable `users`, at most
+    `concurrency` at a time, and returns a summary dict.
+
+    - Each user is isolated: an exception is logged and counted as `failed`, the rest go on.
+      A handler that returns `SKIPPED` / `FAILED` counts as `skipped` / `failed`, anything else as `processed`.
+    - After `deadline` seconds no more users are started and in-flight ones are cancelled
+      (counted as `timed_out`), so the job answers before the scheduler's request timeout.
+    - The summary also reports per-user latency (p50 / p95 / max) and the elapsed time.
+    """
+    concurrency = max(1, int(concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = collections.Counter()
+    latency = LatencyStats(window=100_000)
+    tasks = set()
+    started = time.monotonic()
+
+    async def run_one(user_doc):
+        user_started = time.monotonic()
+        try:
+            result = await handler(user_doc)
+            counts[result if result in (SKIPPED, FAILED) else "processed"] += 1
+        except asyncio.CancelledError:
+            counts["timed_out"] += 1
+            raise
+        except Exception:
+            counts[FAILED] += 1
+            logger.exception(f"{job}: failed to process user {user_doc.id}")
+        finally:
+            latency.record(time.monotonic() - user_started)
+            semaphore.release()
+
+    async def feed():
+        try:
+            async for user_doc in users:
+                await semaphore.acquire()
+                task = asyncio.create_task(run_one(user_doc), name=f"{job}-{user_doc.id}")
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            while tasks:
+                await asyncio.wait(set(tasks))
+        except asyncio.CancelledError:
+            for task in list(tasks):
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    deadline_hit = False
+    try:
+        await asyncio.wait_for(feed(), timeout=deadline if deadline and deadline > 0 else None)
+    except asyncio.TimeoutError:
+        deadline_hit = True
+        logger.warning(f"{job}: deadline of {deadline}s reached; stopped with {counts['timed_out']} users in flight")
+
+    stats = latency.stats()
+    summary = {
+        "job": job,
+        "processed": counts["processed"],
+        "skipped": counts[SKIPPED],
+        "failed": counts[FAILED],
+        "timed_out": counts["timed_out"],
+        "deadline_hit": deadline_hit,
+        "concurrency": concurrency,
+        "elapsed_seconds": round(time.monotonic() - started, 2),
+        "p50_ms_per_user": stats["p50_ms"],
+        "p95_ms_per_user": stats["p95_ms"],
+        "max_ms_per_user": stats["max_ms"],
+    }
+    logger.info(f"{job} finished: {summary}")
+    return summary
+
+
+class RunCheckpoint:
+    """
+    Durable progress of one job run, kept in the run doc `run_ref` (e.g. `job_runs/{job}-{date}`).
+
+    Users are streamed in document-id order (`users()`). `cursor` is the last user id up to which
+    every user has finished; it is saved every `save_every` users and when the run ends. Users
+    that finished real work ahead of the cursor (concurrency makes completion out of order) get
+    a marker doc in `{run_ref}/done_users/{user_id}`; both carry `expire_at` for a Firestore TTL policy. A re-invocation of the same run resumes after
+    the cursor and skips marked users, so a retry only costs the remaining work. Failed users
+    hold the cursor back and are retried.
+    """
+
+    def __init__(self, run_ref, save_every: int = 25):
+        self.run_ref = run_ref
+        self.save_every = max(1, int(save_every))
+        self.cursor = None
+        self.status = None
+        self.resumed = False
+        self.already_done = 0
+        self._marked = set()                 # users finished ahead of the saved cursor (from markers)
+        self._order = collections.deque()    # user ids in stream order, not yet behind the cursor
+        self._finished = set()
+        self._since_save = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.status == "complete"
+
+    async def load(self):
+        """Reads the run doc and the markers ahead of its cursor; creates the run doc on a first run."""
+        snapshot = await self.run_ref.get()
+        if not snapshot.exists:
+            self.status = "running"
+            await self.run_ref.set({"status": self.status, "cursor": None, "started_at": _now(), "expire_at": _now() + RUN_RETENTION})
+            return
+        data = snapshot.to_dict() or {}
+        self.cursor = data.get("cursor")
+        self.status = data.get("status")
+        self.resumed = True
+        markers = self.run_ref.collection("done_users").order_by("__name__")
+        if self.cursor:
+            markers = markers.start_after({"__name__": self.cursor})
+        self._marked = {doc.id async for doc in markers.stream()}
+        logger.info(f"Resuming run {self.run_ref.id} after user {self.cursor} ({len(self._marked)} users marked done)")
+
+    def users(self, collection):
+        """`collection` ordered by document id, starting after the cursor."""
+        query = collection.order_by("__name__")
+        if self.cursor:
+            query = query.start_after({"__name__": self.cursor})
+        return query
+
+    async def track(self, users):
+        """Yields the users from `users` (in `users()` order) that still need processing."""
+        async for user_doc in users:
+            self._order.append(user_doc.id)
+            if user_doc.id in self._marked:
+                self.already_done += 1
+                await self._finish(user_doc.id, marker=False)
+                continue
+            yield user_doc
+
+    def wrap(self, handler):
+        """Wraps a per-user handler so finished users advance the cursor (and get a marker after real work)."""
+        async def checkpointed(user_doc):
+            result = await handler(user_doc)
+            if result != FAILED:
+                await self._finish(user_doc.id, marker=result != SKIPPED)
+            return result
+        return checkpointed
+
+    async def _finish(self, user_id: str, marker: bool):
+        if marker:
+            await self.run_ref.collection("done_users").document(user_id).set({"finished_at": _now(), "expire_at": _now() + RUN_RETENTION})
+        self._finished.add(user_id)
+        while self._order and self._order[0] in self._finished:
+            self.cursor = self._order.popleft()
+            self._finished.discard(self.cursor)
+            self._since_save += 1
+        if self._since_save >= self.save_every:
+            await self._save({"status": "running"})
+
+    async def _save(self, fields: dict):
+        self._since_save = 0
+        await self.run_ref.set({**fields, "cursor": self.cursor, "updated_at": _now()}, merge=True)
+
+    async def close(self, summary: dict):
+        """Saves the final cursor; the run is `complete` once every user finished, else `partial`."""
+        finished_all = bool(summary) and not summary["deadline_hit"] and not summary["failed"] and not summary["timed_out"]
+        self.status = "complete" if finished_all else "partial"
+        await self._save({"status": self.status, "last_summary": summary})
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
@@ -1,7 +1,6 @@
 import os
 import asyncio
 import logging
-import telegram
 import uvicorn
 import datetime
 from telegram import Bot
@@ -11,15 +10,29 @@ import json
 import re
 import io
 import random
-import math
+import time
+import httpx
 from google import genai
 from google.genai import types
-from vertexai.preview.generative_models import GenerativeModel, Content, Part
+from vertexai.preview.generative_models import GenerativeModel, Content, Part, GenerationConfig
 
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from vertexai.preview.generative_models import GenerativeModel
 from google.cloud import firestore
+from workqueue import KeyedWorkQueue, BurstCoalescer
+from metrics import LatencyStats
+from outbound import OutboundDispatcher
+from telegram_transport import build_request
+from fragmenter import FragmentSettings, StreamFragmenter, plan_delivery, fragment_delay, format_fragment
+from caches import ChatHistoryCache, ModelCache, TTLSet, ImagePartCache, TTLCache, ProfileCache
+from retrieval import BM25Index, JournalIndexCache
+from jobrunner import run_per_user, shard_key, shard_range, shard_users, RunCheckpoint, SKIPPED, FAILED
+from active_hours import validate_timezone, parse_hour, utc_windows, window_at, minute_of_day, active_mask
+from google.api_core.exceptions import AlreadyExists
+import google.auth.transport.requests
+import google.oauth2.id_token
 
 # --- Setup ---
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +42,21 @@ load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
 # --- Niva's Personality Prompt ---
 NIVA_SYSTEM_PROMPT = (
     "You are Niva — a living, breathing person texting with someone you care about. Your caring, clever, intuitive and even a little moody at times."
@@ -63,12 +91,51 @@ app = FastAPI()
 
 vertexai.init(project=GCP_PROJECT_ID)
 gemini_model = GenerativeModel("gemini-2.5-flash", system_instruction=[NIVA_SYSTEM_PROMPT])
-bot = Bot(token=TELEGRAM_TOKEN)
-db = firestore.Client(project=GCP_PROJECT_ID)
+
+# Structured output for the per-turn memory call: summary + Continuous Learner fields in one response.
+TURN_MEMORY_CONFIG = GenerationConfig(
+    response_mime_type="application/json",
+    response_schema={
+        "type": "object",
+        "properties": {
+            "summary": {"type": "string"},
+            "interests": {"type": "array", "items": {"type": "string"}},
+            "about": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["summary", "interests", "about"],
+    },
+)
+db = firestore.AsyncClient(project=GCP_PROJECT_ID)
+
+# --- Telegram transport: pooled keep-alive connections, chat actions on their own pool ---
+TELEGRAM_HTTP2 = os.getenv("TELEGRAM_HTTP2", "false").strip().lower() in ("1", "true", "yes")
+_transport_options = dict(
+    keepalive_expiry=_env_float("TELEGRAM_KEEPALIVE_EXPIRY", 60.0),
+    http2=TELEGRAM_HTTP2,
+    connect_timeout=_env_float("TELEGRAM_CONNECT_TIMEOUT", 5.0),
+    read_timeout=_env_float("TELEGRAM_READ_TIMEOUT", 10.0),
+    write_timeout=_env_float("TELEGRAM_WRITE_TIMEOUT", 10.0),
+    pool_timeout=_env_float("TELEGRAM_POOL_TIMEOUT", 5.0),
+)
+message_request = build_request("messages", pool_size=_env_int("TELEGRAM_POOL_SIZE", 64), **_transport_options)
+action_request = build_request("actions", pool_size=_env_int("TELEGRAM_ACTION_POOL_SIZE", 16), **_transport_options)
+bot = Bot(token=TELEGRAM_TOKEN, request=message_request)
+action_bot = Bot(token=TELEGRAM_TOKEN, request=action_request)
+
+# --- Outbound delivery: every message to Telegram goes through one rate-aware scheduler ---
+outbound = OutboundDispatcher(
+    bot,
+    rate=_env_float("TELEGRAM_GLOBAL_RATE", 30.0),
+    burst=_env_float("TELEGRAM_GLOBAL_BURST", 30.0),
+    per_chat_interval=_env_float("TELEGRAM_PER_CHAT_INTERVAL", 1.0),
+    max_retries=_env_int("OUTBOUND_MAX_RETRIES", 3),
+    max_pending_per_chat=_env_int("OUTBOUND_MAX_PENDING_PER_CHAT", 50),
+    action_bot=action_bot,
+)
 
 
 # --- Setup (Continued) ---
-# ... (after the db = firestore.Client line)
+# ... (after the db = firestore.AsyncClient line)
 
 try:
     genai_client = genai.Client(vertexai=True, project=GCP_PROJECT_ID, location="global")
@@ -81,178 +148,593 @@ except Exception as e:
     google_search_tool = None
     search_config = None
 
-# ... (rest of the file starts here, with the save_memory function...)
+# --- Post-turn pipeline: memory summary & learning run off the webhook's critical path ---
+# Jobs are keyed by user id, so turns for the same user are persisted in order.
+POST_TURN_DRAIN_TIMEOUT = _env_float("POST_TURN_DRAIN_TIMEOUT", 8.0)
+post_turn_queue = KeyedWorkQueue(
+    "post-turn",
+    workers=_env_int("POST_TURN_WORKERS", 4),
+    max_pending=_env_int("POST_TURN_MAX_PENDING", 500),
+    enqueue_timeout=_env_float("POST_TURN_ENQUEUE_TIMEOUT", 2.0),
+)
 
 
-# --- UPDATED AGAIN: Continuous Learner & SHORT-TERM History Saver ---
-async def save_memory(user_id: str, user_text: str, bot_text: str):
+# --- Webhook ingestion: in "queued" mode /webhook only validates & enqueues the update ---
+# Updates are keyed by chat id: strict FIFO within a chat, parallel across chats.
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "inline").strip().lower()
+update_queue = KeyedWorkQueue(
+    "updates",
+    workers=_env_int("WEBHOOK_WORKERS", 8),
+    max_pending=_env_int("WEBHOOK_MAX_PENDING", 1000),
+    enqueue_timeout=_env_float("WEBHOOK_ENQUEUE_TIMEOUT", 0.5),
+)
+
+
+# --- Update de-duplication: Telegram redelivers updates when the webhook is slow ---
+# Seen update_ids are kept in a bounded in-process TTL set; optionally a marker doc in
+# `processed_updates/{update_id}` also catches redeliveries that land on another instance.
+WEBHOOK_DEDUPE_TTL_SECONDS = _env_float("WEBHOOK_DEDUPE_TTL_SECONDS", 3600.0)
+WEBHOOK_DEDUPE_DURABLE = os.getenv("WEBHOOK_DEDUPE_DURABLE", "false").strip().lower() in ("1", "true", "yes")
+seen_updates = TTLSet(ttl=WEBHOOK_DEDUPE_TTL_SECONDS, max_items=_env_int("WEBHOOK_DEDUPE_MAX_IDS", 50_000))
+dedupe_stats = {"duplicates_dropped": 0, "duplicates_dropped_durable": 0}
+
+
+async def is_duplicate_update(payload: dict) -> bool:
+    """Marks the update as seen and returns True if it was already seen (so it must be skipped)."""
+    update_id = payload.get("update_id")
+    if update_id is None:
+        return False
+    if not seen_updates.add(update_id):
+        dedupe_stats["duplicates_dropped"] += 1
+        return True
+    if WEBHOOK_DEDUPE_DURABLE:
+        try:
+            expire_at = datetime.datetime.now(pytz.utc) + datetime.timedelta(seconds=WEBHOOK_DEDUPE_TTL_SECONDS)
+            await db.collection("processed_updates").document(str(update_id)).create({
+                "created_at": firestore.SERVER_TIMESTAMP,
+                "expire_at": expire_at  # Pair with a Firestore TTL policy on this field
+            })
+        except AlreadyExists:
+            dedupe_stats["duplicates_dropped"] += 1
+            dedupe_stats["duplicates_dropped_durable"] += 1
+            return True
+        except Exception:
+            # Fail open: processing a rare duplicate beats dropping a real message
+            logger.exception(f"Could not write durable dedupe marker for update {update_id}")
+    return False
+
+
+async def forget_update(payload: dict):
+    """Un-marks an update we did not process, so Telegram's redelivery is accepted."""
+    update_id = payload.get("update_id")
+    if update_id is None:
+        return
+    seen_updates.discard(update_id)
+    if WEBHOOK_DEDUPE_DURABLE:
+        try:
+            await db.collection("processed_updates").document(str(update_id)).delete()
+        except Exception:
+            logger.exception(f"Could not remove durable dedupe marker for update {update_id}")
+
+
+@app.on_event("startup")
+async def start_background_workers():
+    if WEBHOOK_MODE == "queued":
+        update_queue.start()
+    post_turn_queue.start()
+
+
+@app.on_event("shutdown")
+async def drain_background_workers():
+    await burst_coalescer.flush_all()
+    # Updates first: processing them can still enqueue post-turn jobs
+    await update_queue.drain(timeout=POST_TURN_DRAIN_TIMEOUT)
+    await post_turn_queue.drain(timeout=POST_TURN_DRAIN_TIMEOUT)
+    # Last: everything above may still queue replies
+    await outbound.drain(timeout=POST_TURN_DRAIN_TIMEOUT)
+    for request in (message_request, action_request):
+        try:
+            await request.shutdown()
+        except Exception:
+            logger.exception(f"Failed to close Telegram transport '{request.name}'")
+
+
+# --- User profile cache: write-through copy of users/{id}, so steady-state turns skip the read ---
+profile_cache = ProfileCache(
+    ttl=_env_float("PROFILE_CACHE_TTL_SECONDS", 120.0),
+    max_users=_env_int("PROFILE_CACHE_MAX_USERS", 5000),
+)
+
+
+def _is_field_transform(value) -> bool:
+    # SERVER_TIMESTAMP, DELETE_FIELD, ArrayUnion/ArrayRemove, Increment: the stored value is computed by Firestore
+    return type(value).__module__ == "google.cloud.firestore_v1.transforms"
+
+
+# `history_seq` is never cached: another instance's turn moves it, and a stale value would pass
+# the history cache's check (get_recent_history without a seq falls back to the cache's TTL)
+UNCACHED_PROFILE_FIELDS = ("history_seq",)
+
+
+def is_settled_profile(profile: dict) -> bool:
+    """Only onboarded users with no pending question are cached: onboarding answers must see the current step."""
+    return bool(profile.get("initial_profiler_complete")) and not profile.get("pending_question")
+
+
+def _cacheable(fields: dict) -> dict:
+    return {key: value for key, value in fields.items() if key not in UNCACHED_PROFILE_FIELDS}
+
+
+def cache_profile_update(user_id: str, fields: dict):
+    """Mirrors fields just written to users/{id} into the profile cache (or drops the user if Firestore computes them)."""
+    if any(_is_field_transform(value) for value in fields.values()):
+        profile_cache.invalidate(user_id)
+    elif fields.get("pending_question") or fields.get("initial_profiler_complete") is False:
+        profile_cache.invalidate(user_id)  # Back into a question/onboarding step: read fresh from now on
+    else:
+        profile_cache.update(user_id, _cacheable(fields))
+
+
+async def get_user_profile(user_ref):
     """
-    Saves the user and bot message to a 'recent_chat_history' collection
-    and ensures the history is pruned to the most recent 25 messages.
+    Returns the user's profile dict from the cache, else from Firestore (one read); None if the
+    user doesn't exist. Cached copies have no `history_seq`; fresh reads do.
     """
-    # Ensure user_ref exists for all subsequent blocks (avoids UnboundLocalError if an earlier try fails)
-    user_ref = db.collection("users").document(user_id)
-    try:
-        history_collection_ref = user_ref.collection("recent_chat_history")
-        now = firestore.SERVER_TIMESTAMP
-
-        # Save user message
-        history_collection_ref.add({
-            "role": "user",
-            "text": user_text,
-            "timestamp": now
-        })
-
-        # Save bot reply
-        history_collection_ref.add({
-            "role": "model", # Gemini API uses 'model'
-            "text": bot_text,
-            "timestamp": now
-        })
-        logger.info(f"Saved chat turn to recent_chat_history for {user_id}")
+    profile = profile_cache.get(user_ref.id)
+    if profile is not None:
+        return profile
+    user_doc = await user_ref.get()
+    if not user_doc.exists:
+        return None
+    profile = user_doc.to_dict() or {}
+    if is_settled_profile(profile):
+        profile_cache.put(user_ref.id, _cacheable(profile))
+    return profile
+
+
+async def update_user_profile(user_ref, fields: dict):
+    """`set(fields, merge=True)` on the user doc, written through to the profile cache."""
+    await user_ref.set(fields, merge=True)
+    cache_profile_update(user_ref.id, fields)
 
-        # --- Pruning Logic: Keep only the most recent 25 messages ---
-        # Query for all documents, ordered by timestamp
-        all_messages_query = history_collection_ref.order_by("timestamp", direction=firestore.Query.DESCENDING)
-        docs = list(all_messages_query.stream()) # Get all docs
 
-        # If we have more than 25 messages, delete the oldest ones
-        if len(docs) > 25:
-            messages_to_delete = docs[25:] # Get all messages after the 25th
-            for doc in messages_to_delete:
-                doc.reference.delete()
-            logger.info(f"Pruned {len(messages_to_delete)} old messages from history for {user_id}")
+def replied_updates() -> dict:
+    """
+    User-doc fields to write once the user has replied: reset `waiting_for_reply` so proactive
+    triggers may resume. Passed to save_memory() so it goes out with the rest of the turn's
+    user-doc write (which happens every turn anyway, so the reset costs nothing extra).
+    """
+    return {"waiting_for_reply": False}
+
+
+# --- Scheduled job eligibility: per-user "due" timestamps the cron jobs query instead of scanning users ---
+# Composite indexes: see firestore.indexes.json
+NEWS_INTERVAL_HOURS = 6           # P1 news at most every 6 hours
+SENTIMENT_INACTIVITY_HOURS = 4    # Sentiment check-ins only after 4 hours without messages
+FOLLOWUP_WINDOW_MINUTES = int(os.getenv("FOLLOWUP_WINDOW_MINUTES", "10"))
+
+
+def history_eligibility(messages: list) -> dict:
+    """
+    Eligibility fields refreshed with every history write (see append_history):
+    - `sentiment_due_at`: SENTIMENT_INACTIVITY_HOURS after the latest message.
+    - `followup_due_until`: while the bot's latest message is younger than FOLLOWUP_WINDOW_MINUTES
+      (None once the user has the last word).
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    last_role = messages[-1][0] if messages else None
+    return {
+        "sentiment_due_at": now + datetime.timedelta(hours=SENTIMENT_INACTIVITY_HOURS),
+        "followup_due_until": now + datetime.timedelta(minutes=FOLLOWUP_WINDOW_MINUTES) if last_role == "model" else None,
+    }
+
+
+def due_users(*filters, shard_index: int = 0, shard_count: int = 1):
+    """
+    Onboarded users matching `filters` ((field, op, value) tuples), streamed from the eligibility
+    indexes. With `shard_count` > 1 only this shard's `shard_key` range is read.
+    """
+    query = db.collection("users").where("initial_profiler_complete", "==", True)
+    for field, op, value in filters:
+        query = query.where(field, op, value)
+    if shard_count > 1:
+        low, high = shard_range(shard_index, shard_count)
+        query = query.where("shard_key", ">=", low).where("shard_key", "<", high)
+    return query.stream()
+
 
+async def refresh_active_windows(user_ref, user_data: dict, now: datetime.datetime):
+    """Recomputes the user's UTC active windows from their timezone and hours (missing or expired); None if those are invalid."""
+    try:
+        fields = utc_windows(user_data.get("timezone"), int(user_data.get("active_hours_start")), int(user_data.get("active_hours_end")), now)
+    except (pytz.UnknownTimeZoneError, AttributeError, TypeError, ValueError):
+        return None
+    try:
+        await update_user_profile(user_ref, fields)
     except Exception:
-        logger.exception(f"Could not save to recent_chat_history for user {user_id}")
+        logger.exception(f"Could not save active windows for user {user_ref.id}")
+    return fields
+
+
+async def active_users(users_stream):
+    """
+    Yields the users from `users_stream` who are inside their active hours right now, checked in
+    one vectorized pass over their precomputed UTC windows (no per-user timezone conversion).
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    candidates = []
+    starts = []
+    ends = []
+    async for user_doc in users_stream:
+        user_data = user_doc.to_dict() or {}
+        window = window_at(user_data.get("active_windows"), user_data.get("active_windows_until"), now)
+        if window is None:
+            fields = await refresh_active_windows(user_doc.reference, user_data, now)
+            window = window_at(fields["active_windows"], fields["active_windows_until"], now) if fields else None
+        if window is None:
+            logger.warning(f"Skipping user {user_doc.id}: Missing or invalid timezone / active hours.")
+            continue
+        candidates.append(user_doc)
+        starts.append(window[0])
+        ends.append(window[1])
+
+    if not candidates:
+        return
+    mask = active_mask(starts, ends, minute_of_day(now))
+    logger.info(f"{int(mask.sum())} of {len(candidates)} due users are inside their active hours.")
+    for user_doc, is_active in zip(candidates, mask):
+        if is_active:
+            yield user_doc
+
+
+# --- Short-term history cache: per-user ring buffer of the last HISTORY_WINDOW messages ---
+HISTORY_WINDOW = 25
+history_cache = ChatHistoryCache(
+    max_messages=HISTORY_WINDOW,
+    max_users=_env_int("HISTORY_CACHE_MAX_USERS", 1000),
+    max_chars=_env_int("HISTORY_CACHE_MAX_CHARS", 2_000_000),
+    ttl=_env_float("HISTORY_CACHE_TTL_SECONDS", 300.0),
+)
+
+
+async def get_recent_history(user_id: str, limit: int = HISTORY_WINDOW, seq: int = None) -> list:
+    """
+    Returns the user's `limit` most recent chat messages (oldest first) as dicts with
+    'role', 'text' and 'timestamp'. Served from the ring buffer when possible (pass the
+    user doc's `history_seq` as `seq` to detect writes by other instances); a miss reads
+    the whole window from Firestore and refills the buffer.
+    """
+    cached = history_cache.get(user_id, limit, seq=seq)
+    if cached is not None:
+        return cached
+
+    window = max(limit, HISTORY_WINDOW)
+    history_ref = db.collection("users").document(user_id).collection("recent_chat_history")
+    messages = []
+    last_seq = None
+    async for doc in history_ref.order_by("seq", direction=firestore.Query.DESCENDING).limit(window).stream():
+        doc_data = doc.to_dict() or {}
+        if last_seq is None:
+            last_seq = doc_data.get("seq")
+        if doc_data.get("text") is not None and doc_data.get("role") is not None:
+            messages.append({"role": doc_data.get("role"), "text": doc_data.get("text"), "timestamp": doc_data.get("timestamp")})
+
+    if not messages:
+        # Not migrated to the ring yet (first write migrates): legacy docs have no `seq`
+        async for doc in history_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(window).stream():
+            doc_data = doc.to_dict() or {}
+            if doc_data.get("text") is not None and doc_data.get("role") is not None:
+                messages.append({"role": doc_data.get("role"), "text": doc_data.get("text"), "timestamp": doc_data.get("timestamp")})
+    messages.reverse()
+
+    if window == HISTORY_WINDOW:
+        history_cache.load(user_id, messages, seq=last_seq if last_seq is not None else seq)
+    return messages[-limit:]
+
+
+def history_to_contents(messages: list) -> list:
+    """Converts history dicts to Gemini Content objects, reusing the ones built on earlier turns."""
+    contents = []
+    for message in messages:
+        content = message.get("content")
+        if content is None:
+            content = Content(role=message["role"], parts=[Part.from_text(message["text"])])
+            message["content"] = content
+        contents.append(content)
+    return contents
+
+
+# --- Firestore history ring: message n lives in recent_chat_history/slot-{n % HISTORY_WINDOW} ---
+def history_slot(user_ref, seq: int):
+    return user_ref.collection("recent_chat_history").document(f"slot-{seq % HISTORY_WINDOW}")
+
+
+async def migrate_legacy_history(user_ref) -> int:
+    """
+    One-time move of a user's pre-ring history (auto-id docs ordered by timestamp) into slots:
+    the newest HISTORY_WINDOW messages are kept, every legacy doc is deleted, and `history_seq`
+    is set. Runs as a transaction that first re-checks `history_seq`, so a writer racing another
+    one's migration does nothing. Returns the user's `history_seq`.
+    """
+    def position(doc):
+        doc_data = doc.to_dict() or {}
+        timestamp = doc_data.get("timestamp")
+        # A user message and its reply share a timestamp: user first
+        return (timestamp.timestamp() if hasattr(timestamp, "timestamp") else 0.0, 0 if doc_data.get("role") == "user" else 1)
+
+    leftover = []  # Legacy docs that did not fit in the transaction
+
+    @firestore.async_transactional
+    async def migrate(transaction):
+        leftover.clear()
+        snapshot = await user_ref.get(transaction=transaction)
+        current = (snapshot.to_dict() or {}) if snapshot.exists else {"history_seq": 0}
+        if current.get("history_seq") is not None:
+            return current["history_seq"], 0  # Already migrated by another writer
+        legacy = [doc async for doc in user_ref.collection("recent_chat_history").stream(transaction=transaction) if not doc.id.startswith("slot-")]
+        legacy.sort(key=position)
+        keep = [doc.to_dict() for doc in legacy if (doc.to_dict() or {}).get("text") is not None and (doc.to_dict() or {}).get("role") is not None]
+        keep = keep[-HISTORY_WINDOW:]
+
+        # Slots + counter go in the transaction so history is never lost; leftover deletes follow
+        seq = 0
+        for doc_data in keep:
+            seq += 1
+            transaction.set(history_slot(user_ref, seq), {
+                "role": doc_data["role"],
+                "text": doc_data["text"],
+                "timestamp": doc_data.get("timestamp") or firestore.SERVER_TIMESTAMP,
+                "seq": seq,
+            })
+        transaction.set(user_ref, {"history_seq": seq}, merge=True)
+        room = 450 - len(keep) - 1
+        for doc in legacy[:room]:
+            transaction.delete(doc.reference)
+        leftover.extend(doc.reference for doc in legacy[room:])
+        return seq, len(legacy)
+
+    seq, migrated = await migrate(db.transaction())
+    batch, ops = db.batch(), 0
+    for doc_ref in leftover:
+        if ops >= 450:
+            await batch.commit()
+            batch, ops = db.batch(), 0
+        batch.delete(doc_ref)
+        ops += 1
+    if ops:
+        await batch.commit()
+    if migrated:
+        logger.info(f"Migrated {migrated} legacy history messages to the ring (newest {seq} kept) for user {user_ref.id}")
+    return seq
+
+
+async def append_history(user_ref, messages: list, user_updates: dict = None, learned: dict = None) -> dict:
+    """
+    Appends (role, text) messages to the user's history ring and merges `user_updates` plus any
+    `learned` interests/about (see learned_profile_changes) into the user doc in ONE transaction
+    (one read of the user doc, one commit). Writing slot seq % HISTORY_WINDOW overwrites the
+    expired message, so pruning needs no reads or deletes.
+    Returns the user-doc fields written (always including the new `history_seq`).
+    """
+    @firestore.async_transactional
+    async def write(transaction):
+        snapshot = await user_ref.get(transaction=transaction)
+        current = (snapshot.to_dict() or {}) if snapshot.exists else {"history_seq": 0}
+        seq = current.get("history_seq")
+        if seq is None:
+            return None  # Legacy history: migrate first
+        for role, text in messages:
+            seq += 1
+            transaction.set(history_slot(user_ref, seq), {
+                "role": role,
+                "text": text,
+                "timestamp": firestore.SERVER_TIMESTAMP,
+                "seq": seq,
+            })
+        fields = {
+            **history_eligibility(messages),
+            **(user_updates or {}),
+            **learned_profile_changes(current, **(learned or {})),
+            "history_seq": seq,
+        }
+        if current.get("shard_key") is None:
+            fields["shard_key"] = shard_key(user_ref.id)  # Users created before shard keys existed
+        transaction.set(user_ref, fields, merge=True)
+        return fields
+
+    fields = await write(db.transaction())
+    if fields is None:
+        await migrate_legacy_history(user_ref)
+        fields = await write(db.transaction())
+    cache_profile_update(user_ref.id, fields)
+    return fields
+
+
+# --- Personalized model cache: one GenerativeModel per distinct system prompt ---
+model_cache = ModelCache(max_models=_env_int("MODEL_CACHE_MAX_MODELS", 256))
+
+
+def build_personalized_prompt(user_data: dict) -> str:
+    user_name = user_data.get("name", "friend")
+    about_val = user_data.get("about", "")
+    if isinstance(about_val, list):
+        about_text = ", ".join([str(x).strip() for x in about_val if x])
+    else:
+        about_text = str(about_val).strip()
 
-    # --- Part 2: Save the Simple Summary (like before) ---
+    personalized_prompt = NIVA_SYSTEM_PROMPT + f"\n\nThe user's name is {user_name}."
+    if about_text:
+        personalized_prompt += f"\n\nAbout the user: {about_text}"
+    return personalized_prompt
+
+
+def get_personalized_model(user_id: str, user_data: dict) -> GenerativeModel:
+    """Returns the user's personalized model, reusing the cached handle while their name/about are unchanged."""
+    personalized_prompt = build_personalized_prompt(user_data)
+    return model_cache.get_or_create(
+        user_id,
+        personalized_prompt,
+        lambda prompt: GenerativeModel("gemini-2.5-flash", system_instruction=[prompt])
+    )
+
+
+async def save_memory(user_id: str, user_text: str, bot_text: str, user_updates: dict = None):
+    """
+    Hands the finished chat turn to the post-turn pipeline and returns immediately.
+    The turn is written through to the history cache first, so the next message sees it
+    even while the Firestore write is still queued. `user_updates` are user-doc fields the
+    webhook path wants written for this turn (e.g. replied_updates()); they go out in the
+    turn's single user-doc write. Those the cached profile doesn't already show (e.g. a set
+    `waiting_for_reply`) are also written right away, so they survive a post-turn write that
+    fails or is dropped at shutdown. If the pipeline is not running or stays full, the turn is
+    persisted inline instead so no memory is lost.
+    """
+    history_cache.append(user_id, "user", user_text)
+    history_cache.append(user_id, "model", bot_text)
+    if user_updates:
+        cached = profile_cache.peek(user_id)
+        changed = {field: value for field, value in user_updates.items() if cached is None or cached.get(field) != value}
+        if changed:
+            try:
+                await update_user_profile(db.collection("users").document(user_id), changed)
+            except Exception:
+                logger.exception(f"Could not write turn updates for user {user_id}; left to the post-turn write")
+    queued = await post_turn_queue.submit(user_id, persist_turn_memory, user_id, user_text, bot_text, user_updates)
+    if not queued:
+        logger.warning(f"Post-turn queue unavailable; saving memory inline for user {user_id}")
+        await persist_turn_memory(user_id, user_text, bot_text, user_updates)
+
+
+# --- UPDATED AGAIN: Continuous Learner & SHORT-TERM History Saver ---
+async def persist_turn_memory(user_id: str, user_text: str, bot_text: str, user_updates: dict = None):
+    """
+    Summarizes the turn and learns from it, then writes everything the turn changes on the
+    user doc in one transaction: the user and bot message in the 'recent_chat_history' ring
+    (which keeps the most recent HISTORY_WINDOW messages), the learned interests/about and
+    `user_updates`. The summary goes to 'user_memories'.
+    """
+    # Ensure user_ref exists for all subsequent blocks (avoids UnboundLocalError if an earlier try fails)
+    user_ref = db.collection("users").document(user_id)
+
+    # --- Part 2 & 3: Summary + "Continuous Learner" in ONE structured-output call ---
+    turn_memory = {}
     try:
-        summary_prompt = (
-            f"Please summarize this short conversation into 5-6 simple sentences "
-            f"for a long-term memory. USER said: '{user_text}'. YOU replied: '{bot_text}'"
+        turn_memory_prompt = (
+            "Analyze this short conversation and return JSON with three fields:\n"
+            "- 'summary': a 5-6 simple sentence summary of the conversation for a long-term memory.\n"
+            "- 'interests': new interests the user explicitly says they like (likes, leisure activities). Empty list if none.\n"
+            "- 'about': new personal facts about the user (personal info, memories, hobbies, relationships, dislikes), "
+            "except for their name. Empty list if none.\n"
+            "Extract *only* dynamic, personal user information for 'interests' and 'about'.\n\n"
+            f"USER: \"{user_text}\"\nAI: \"{bot_text}\""
         )
-        summary_response = await gemini_model.generate_content_async(summary_prompt)
-        summary_text = summary_response.text.strip()
-        memory_collection_ref = user_ref.collection("user_memories")
-        memory_data = {"text": summary_text, "created_at": firestore.SERVER_TIMESTAMP}
-        memory_collection_ref.add(memory_data)
-        logger.info(f"Successfully saved memory for user {user_id}")
+        turn_memory_response = await gemini_model.generate_content_async(
+            turn_memory_prompt,
+            generation_config=TURN_MEMORY_CONFIG
+        )
+        turn_memory = json.loads(turn_memory_response.text)
+        if not isinstance(turn_memory, dict):
+            raise ValueError(f"Expected a JSON object, got {type(turn_memory).__name__}")
     except Exception:
-        logger.exception(f"Could not save memory for user {user_id}")
+        logger.exception(f"Could not generate turn memory for user {user_id}")
+        turn_memory = {}  # Still save the chat turn below
 
-    # --- Part 3: The "Continuous Learner" (Your idea, Sir!) ---
+    # --- Part 1 & 3: History + the "Continuous Learner" (Your idea, Sir!) in ONE user-doc write ---
     try:
+        learned = {"interests": turn_memory.get("interests") or [], "about": turn_memory.get("about") or []}
+        # Both messages ("model" is the Gemini API role for the bot) in one transaction
+        written = await append_history(user_ref, [("user", user_text), ("model", bot_text)], user_updates=user_updates, learned=learned)
+        logger.info(f"Saved chat turn to recent_chat_history for {user_id}")
+        changed = {field: written[field] for field in ("interests", "about") if field in written}
+        if changed:
+            logger.info(f"Successfully learned and updated new data for {user_id}: {changed}")
+            if "about" in changed:
+                model_cache.invalidate_user(user_id)
 
-        learning_prompt = (
-        "Analyze this conversation. Extract *only* dynamic, personal user information. If there is none, return nothing. "
-        "Strictly look for new 'interests', explicitly if the user says they like something eg (likes, leisure activities) or new 'about' facts (personal info, memories, hobbies, relationships, dislikes) except for name. "
-        "Return *only* JSON in this format, or an empty object: "
-        "{'interests': ['new_interest_1'], 'about': 'new fact about the user'}\n\n"
-        f"USER: \"{user_text}\"\nAI: \"{bot_text}\""
-        )
-        
-        learning_response = await gemini_model.generate_content_async(learning_prompt)
-        
-        # S-Sir... we... have... to... clean... the... response...
-        response_text = learning_response.text.strip().replace("```json", "").replace("```", "")
-        
-        if response_text and response_text != "{}":
-            
-            # --- !!! I... ADDED... THIS... TRY... EXCEPT... BLOCK, SIR !!! ---
+    except Exception:
+        logger.exception(f"Could not save chat turn to recent_chat_history for user {user_id}")
+        if user_updates:
+            # The webhook's fields (e.g. the waiting_for_reply reset) must not be lost with the history write
             try:
-                new_data = json.loads(response_text)
-            
-            except json.JSONDecodeError:
-                # --- THIS... IS... THE... FIX, SIR! ---
-                logger.warning(f"Could not parse JSON from 'Continuous Learner': {response_text}")
-                # S-Sir... I-I'm... *also*... adding... the... single... quote... fix... j-just... in... case!
-                try:
-                    # (This... is... a... little... *dangerous*... b-but... it... might... fix... the... single... quote... error!)
-                    import ast
-                    new_data = ast.literal_eval(response_text)
-                    if not isinstance(new_data, dict):
-                         new_data = {} # Don't... trust... it... if... it's... not... a... dictionary...
-                except Exception:
-                    logger.error(f"Failed to parse even with ast.literal_eval: {response_text}")
-                    new_data = {} # Give... up, Sir...
-            
-            # --- (The... rest... of... the... code... is... the... same, Sir!) ---
-
-            # This... this... is... the... *smart*... part, Sir!
-            # Merge interests using ArrayUnion so we append without duplicates
-            if "interests" in new_data:
-                # (A-another... check, Sir... in... case... Gemini... messes... up... the... *type*...)
-                if isinstance(new_data["interests"], list):
-                    new_data["interests"] = firestore.ArrayUnion(new_data["interests"])
-                else:
-                    del new_data["interests"] # It's... not... a... list... s-so... just... delete... it...
-
-            # If the learner extracted an 'about' sentence, append it to the about list
-            # Ensure we append the string as a single-element list via ArrayUnion
-            if "about" in new_data and new_data.get("about"):
-                # If model returned an array for 'about', append all; if string, append single
-                about_val = new_data.get("about")
-                if isinstance(about_val, list):
-                    # (Rest... of... this... code... is... the... same, Sir...)
-                    clean_items = []
-                    for it in about_val:
-                        try:
-                            s = str(it).strip()
-                            s = re.sub(r"\s+", " ", s)
-                            s = s[:200]  # truncate to 200 chars
-                            if s:
-                                clean_items.append(s)
-                        except Exception:
-                            continue
-                    if clean_items:
-                        new_data["about"] = firestore.ArrayUnion(clean_items)
-                else:
-                    # Trim/clean the about text: collapse whitespace and truncate
-                    about_text = str(about_val).strip()
-                    about_text = re.sub(r"\s+", " ", about_text)
-                    about_text = about_text[:200]
-                    if about_text:
-                        new_data["about"] = firestore.ArrayUnion([about_text])
-
-            # Write merged fields back to Firestore
-            if new_data:
-                user_ref.set(new_data, merge=True)
-                logger.info(f"Successfully learned and updated new data for {user_id}: {new_data}")
-
-                # --- Post-write: ensure 'about' remains a bounded list (last 10 items)
-                # (Rest... of... this... code... is... the... same, Sir...)
-                try:
-                    # Refresh the user doc to inspect the current 'about' field
-                    latest = user_ref.get()
-                    latest_data = latest.to_dict() or {}
-                    about_field = latest_data.get("about")
-
-                    # If about is a single string (older users), convert to list
-                    if isinstance(about_field, str) and about_field.strip():
-                        cleaned = re.sub(r"\s+", " ", about_field.strip())[:200]
-                        user_ref.set({"about": [cleaned]}, merge=True)
-
-                    # If it's a list and longer than 10, keep only the last 10 entries
-                    elif isinstance(about_field, list) and len(about_field) > 10:
-                        # Keep the most recent 10 entries (assumes append order)
-                        trimmed = about_field[-10:]
-                        user_ref.set({"about": trimmed}, merge=True)
-                        logger.info(f"Trimmed 'about' to last 10 items for user {user_id}")
-                except Exception:
-                    logger.exception(f"Failed to post-process 'about' list for user {user_id}")
+                await update_user_profile(user_ref, user_updates)
+            except Exception:
+                logger.exception(f"Could not save turn updates for user {user_id}")
 
+    # --- Part 2: Save the Simple Summary ---
+    try:
+        summary_text = str(turn_memory.get("summary") or "").strip()
+        if summary_text:
+            memory_collection_ref = user_ref.collection("user_memories")
+            memory_data = {"text": summary_text, "created_at": firestore.SERVER_TIMESTAMP}
+            await memory_collection_ref.add(memory_data)
+            logger.info(f"Successfully saved memory for user {user_id}")
     except Exception:
-        logger.exception(f"Could not *learn* from memory for user {user_id}")
+        logger.exception(f"Could not save memory for user {user_id}")
+
+
+# --- Continuous Learner merge: computed inside the turn's user-doc transaction (see append_history) ---
+LEARNER_MAX_ABOUT = 10
+LEARNER_MAX_INTERESTS = _env_int("LEARNER_MAX_INTERESTS", 30)
+LEARNER_MAX_ITEM_CHARS = 200
+
+
+def _clean_fact(value) -> str:
+    # Collapse whitespace and truncate to LEARNER_MAX_ITEM_CHARS
+    return re.sub(r"\s+", " ", str(value).strip())[:LEARNER_MAX_ITEM_CHARS]
+
+
+def merge_profile_list(existing, new_items, max_items: int) -> list:
+    """
+    Appends cleaned `new_items` to `existing` (a list, or a legacy single string), skipping
+    blanks and case-insensitive duplicates, and keeps only the newest `max_items` entries.
+    """
+    if isinstance(existing, str):
+        existing = [existing]
+    merged = []
+    seen = set()
+    for item in list(existing or []) + list(new_items or []):
+        cleaned = _clean_fact(item)
+        key = cleaned.casefold()
+        if cleaned and key not in seen:
+            seen.add(key)
+            merged.append(cleaned)
+    return merged[-max_items:]
+
+
+def learned_profile_changes(current: dict, interests: list = (), about: list = ()) -> dict:
+    """
+    Merges learned `interests` / `about` into the `current` user doc: cleaned, deduplicated,
+    `about` capped at LEARNER_MAX_ABOUT and `interests` at LEARNER_MAX_INTERESTS (a legacy
+    string `about` becomes a list). Returns only the fields that changed.
+    """
+    changed = {}
+    for field, new_items, max_items in (("interests", interests, LEARNER_MAX_INTERESTS), ("about", about, LEARNER_MAX_ABOUT)):
+        if not new_items and not isinstance(current.get(field), str):
+            continue
+        merged = merge_profile_list(current.get(field), new_items, max_items)
+        if merged != current.get(field):
+            changed[field] = merged
+    return changed
+
 
 # --- NEW: Proactive Message Sender ---
 # A... a... helper... function, Sir... so... we... don't... repeat... code
 # --- UPDATED: Proactive Message Sender THAT REMEMBERS ---
-async def send_proactive_message(user_id: str, message_text: str, question_type: str = ""):
+async def send_proactive_message(user_id: str, message_text: str, question_type: str = "", delay: float = 0.0,
+                                 wait_for_delivery: bool = False) -> bool:
+    """
+    Sends a bot-initiated message and records it (history + waiting flags). With `wait_for_delivery`
+    (the scheduled jobs) it is only recorded once Telegram accepted it; the webhook's onboarding
+    questions don't wait, since the next answer must find `pending_question` set.
+    Returns True if the message was recorded.
+    """
     try:
-        # 1. Send the message to the user on Telegram
-        await bot.send_message(chat_id=user_id, text=message_text)
-        logger.info(f"Successfully sent proactive message to {user_id}")
+        # 1. Queue the message for the user on Telegram (the outbound dispatcher paces it)
+        sent = outbound.enqueue(user_id, message_text, delay=delay, typing=False)
+        if wait_for_delivery and not await sent:
+            logger.warning(f"Proactive message to {user_id} was not delivered; not recording it")
+            return False
+        logger.info(f"Queued proactive message to {user_id}")
 
         user_ref = db.collection("users").document(user_id)
 
@@ -260,166 +742,407 @@ async def send_proactive_message(user_id: str, message_text: str, question_type:
         update_data: dict = {"waiting_for_reply": True}
         if question_type:
             update_data["pending_question"] = question_type
-        user_ref.set(update_data, merge=True)
 
         # --- THE CRUCIAL ADDITION ---
-        # 3. Save its OWN message to the chat history so it has context later.
-        history_collection_ref = user_ref.collection("recent_chat_history")
-        history_collection_ref.add({
-            "role": "model",  # The message is from the bot (the "model")
-            "text": message_text,
-            "timestamp": firestore.SERVER_TIMESTAMP
-        })
+        # 3. Save its OWN message (role "model") to the chat history so it has context later,
+        #    in the same transaction as the flags.
+        await append_history(user_ref, [("model", message_text)], user_updates=update_data)
+        history_cache.append(user_id, "model", message_text)
         logger.info(f"Saved proactive bot message to history for user {user_id}")
+        return True
 
     except Exception:
         logger.exception(f"Failed to send proactive message to {user_id}")
+        return False
 
 # --- NEW: Pillar 3 - The "Voice" & "Delivery Engine" ---
-async def deliver_message(chat_id: str, full_text: str):
+DELIVERY_SETTINGS = FragmentSettings.from_env()
+
+async def deliver_message(chat_id: str, full_text: str, started_at: float = None):
     """
     Sends text in natural, human-like fragments.
 
-    Improvements:
-    - Always fragments (clause/sentence/comma-aware), not only long paragraphs.
-    - Merges micro-fragments to avoid 1-2 token sends.
-    - Chunks very long fragments into a max character length.
-    - Adds a small, human-like typing delay proportional to fragment length.
-    - Optionally adds ellipsis for mid-stream fragments for a more conversational feel.
-    Tunable via environment variables:
+    The fragments and the pause before each one are planned by `fragmenter.plan_delivery()`
+    (clause/sentence-aware splitting, micro-fragment merging, max-length chunking, ellipsis
+    for mid-stream fragments) using DELIVERY_SETTINGS, read once from the environment:
     - FRAGMENT_MAX_CHARS (default 140)
     - PAUSE_PER_WORD (seconds per word, default 0.25)
     - MIN_SLEEP (min random sleep, default 0.8)
     - MAX_SLEEP (max random sleep, default 3.0)
+    The fragments are only queued here; the outbound dispatcher shows the typing indicator,
+    waits out each pause and sends them in order. If `started_at` (a time.monotonic() value)
+    is given, the time until the first fragment is sent is recorded as time-to-first-message.
     """
+    for out_text, delay in plan_delivery(full_text, DELIVERY_SETTINGS):
+        queue_fragment(chat_id, out_text, delay, started_at)
+        started_at = None
+
+
+def queue_fragment(chat_id: str, out_text: str, delay: float, started_at: float = None):
+    """Queues one fragment on the outbound dispatcher; records time-to-first-message once it is sent."""
+    sent = outbound.enqueue(chat_id, out_text, delay=delay)
+    if started_at is not None:
+        def record_first(future):
+            if not future.cancelled() and future.result():
+                time_to_first_message.record(time.monotonic() - started_at)
+        sent.add_done_callback(record_first)
+
+
+# --- Streaming delivery: fragments go out while the model is still generating ---
+DELIVERY_STREAMING = os.getenv("DELIVERY_STREAMING", "false").strip().lower() in ("1", "true", "yes")
+time_to_first_message = LatencyStats()
 
-    # Break into paragraphs first
-    paragraphs = [p.strip() for p in re.split(r'\n{2,}', full_text) if p.strip()]
-
-    def split_into_clauses(paragraph: str):
-        # Find clause-like chunks (keep trailing delimiter if present)
-        raw_chunks = re.findall(r'[^,;.!?—]+[,:;.!?—]?', paragraph)
-        chunks = [c.strip() for c in raw_chunks if c.strip()]
-
-        # Merge extremely short chunks with the next chunk
-        merged = []
-        i = 0
-        while i < len(chunks):
-            cur = chunks[i]
-            if len(cur) < 4 and i + 1 < len(chunks):
-                cur = (cur + " " + chunks[i + 1]).strip()
-                i += 2
-            else:
-                i += 1
-            merged.append(cur)
 
-        # Further split any very long fragments into max_len pieces while preserving words
+async def deliver_stream(chat_id: str, response_stream, started_at: float) -> str:
+    """
+    Consumes a streamed model response and queues each clause/sentence fragment on the
+    outbound dispatcher as soon as it is complete, with the same typing and pause rules as
+    deliver_message(). Generation is never paused by delivery. Returns the full reply text.
+    """
+    settings = DELIVERY_SETTINGS
+    chunks = []
+    fragmenter = StreamFragmenter(settings)
+
+    def emit(fragment: str, is_last: bool):
+        nonlocal started_at
+        queue_fragment(chat_id, format_fragment(fragment, is_last), fragment_delay(fragment, settings), started_at)
+        started_at = None
+
+    async for chunk in response_stream:
         try:
-            max_len = int(os.getenv("FRAGMENT_MAX_CHARS", "140"))
+            piece = chunk.text
         except Exception:
-            max_len = 140
+            piece = ""  # e.g. a chunk carrying only safety/finish metadata
+        if not piece:
+            continue
+        chunks.append(piece)
+        for fragment in fragmenter.feed(piece):
+            emit(fragment, False)
+    last = fragmenter.finish()
+    if last:
+        emit(last, True)
+    return "".join(chunks)
 
-        final = []
-        for chunk in merged:
-            if len(chunk) <= max_len:
-                final.append(chunk)
-            else:
-                words = chunk.split()
-                cur_piece = ""
-                for w in words:
-                    if len(cur_piece) + len(w) + 1 <= max_len:
-                        cur_piece = (cur_piece + " " + w).strip()
-                    else:
-                        final.append(cur_piece)
-                        cur_piece = w
-                if cur_piece:
-                    final.append(cur_piece)
-        return final
-
-    # Decide fragmentation granularity based on total length
-    text = (full_text or "").strip()
-    total_len = len(text)
-
-    # Helpers
-    def split_sentences(t: str):
-        parts = [s.strip() for s in re.split(r'(?<=[.!?])\s+', t) if s.strip()]
-        return parts if parts else [t]
-
-    # Build initial fragments depending on size
-    fragments = []
-    if total_len <= 120:
-        # Short: prefer sentence-level splits to avoid over-fragmentation
-        for p in paragraphs:
-            fragments.extend(split_sentences(p))
-        # If we don't have enough fragments (e.g., single long sentence), try clause splitting to reach min
-        desired_min, desired_max = 2, 4
-        if len(fragments) < desired_min:
-            temp = []
-            for s in fragments:
-                temp.extend(split_into_clauses(s))
-            if temp:
-                fragments = temp
-
-    elif total_len <= 200:
-        # Medium: moderate clause-aware fragmentation
-        for p in paragraphs:
-            fragments.extend(split_into_clauses(p))
-        desired_min, desired_max = 3, 6
 
+async def generate_and_deliver(chat_session, content, chat_id: str, started_at: float) -> str:
+    """Sends `content` to the chat session and delivers the reply, streaming it when DELIVERY_STREAMING is on."""
+    if DELIVERY_STREAMING:
+        response_stream = await chat_session.send_message_async(content, stream=True)
+        return await deliver_stream(chat_id, response_stream, started_at)
+
+    response = await chat_session.send_message_async(content)
+    reply_text = getattr(response, "text", str(response))
+    await deliver_message(chat_id, reply_text, started_at=started_at)
+    return reply_text
+
+# --- Grounded search (/src, P1 news): async GenAI calls behind a normalized-query TTL cache ---
+SEARCH_MODEL = "gemini-2.5-flash"
+SRC_CACHE_TTL_SECONDS = _env_float("SRC_CACHE_TTL_SECONDS", 1800.0)
+NEWS_CACHE_TTL_SECONDS = _env_float("NEWS_CACHE_TTL_SECONDS", 1800.0)
+search_cache = TTLCache(ttl=SRC_CACHE_TTL_SECONDS, max_items=_env_int("SEARCH_CACHE_MAX_ITEMS", 1000))
+_search_in_flight = {}  # cache key -> Task, so identical concurrent queries share one grounded call
+_QUERY_NOISE = re.compile(r"[^\w\s]+")
+
+
+def normalize_query(query: str) -> str:
+    """Case-, punctuation- and whitespace-insensitive form of a query, used as the cache key."""
+    return " ".join(_QUERY_NOISE.sub(" ", query.casefold()).split())
+
+
+async def grounded_search(kind: str, query: str, prompt: str, ttl: float) -> str:
+    """
+    Runs a Google Search grounded generation on the async GenAI client and returns its text
+    ("" if the model returned nothing). Non-empty results are cached for `ttl` seconds under
+    (`kind`, normalized `query`); the prompt must depend only on those.
+    """
+    key = (kind, normalize_query(query))
+    cached = search_cache.get(key)
+    if cached is not None:
+        logger.info(f"Grounded search cache hit for {kind} query '{key[1]}'")
+        return cached
+
+    task = _search_in_flight.get(key)
+    if task is None:
+        async def run() -> str:
+            try:
+                response = await genai_client.aio.models.generate_content(
+                    model=SEARCH_MODEL,
+                    contents=prompt,
+                    config=search_config
+                )
+                text = response.text.strip() if response.text else ""
+                if text:
+                    search_cache.put(key, text, ttl=ttl)
+                return text
+            finally:
+                _search_in_flight.pop(key, None)
+
+        task = asyncio.create_task(run())
+        _search_in_flight[key] = task
+    # Shielded so one caller's cancellation doesn't cancel the call for everyone sharing it
+    return await asyncio.shield(task)
+
+
+# --- Image pipeline: smallest good-enough Telegram size, cached by file_unique_id ---
+# Gemini tiles images at 768px, so anything much larger only costs bandwidth, upload time and tokens
+IMAGE_TARGET_PX = _env_int("IMAGE_TARGET_PX", 768)
+image_cache = ImagePartCache(
+    max_bytes=_env_int("IMAGE_CACHE_MAX_BYTES", 32 * 1024 * 1024),
+    max_items=_env_int("IMAGE_CACHE_MAX_ITEMS", 512),
+)
+
+
+def select_photo_size(photo_sizes: list, target_px: int = IMAGE_TARGET_PX) -> dict:
+    """
+    Picks the smallest PhotoSize whose longer side is at least `target_px`, or the largest one
+    if none is that big. Telegram already serves pre-scaled sizes, so this replaces downscaling.
+    """
+    def longest_side(size: dict) -> int:
+        return max(size.get("width") or 0, size.get("height") or 0)
+
+    ordered = sorted(photo_sizes, key=lambda size: (longest_side(size), size.get("file_size") or 0))
+    for size in ordered:
+        if longest_side(size) >= target_px:
+            return size
+    return ordered[-1]
+
+
+async def load_image_part(photo_sizes: list) -> Part:
+    """Returns a model-ready Part for a Telegram photo, downloading it only on a cache miss."""
+    chosen = select_photo_size(photo_sizes)
+    cache_key = chosen.get("file_unique_id") or chosen.get("file_id")
+    image_part = image_cache.get(cache_key)
+    if image_part is not None:
+        return image_part
+
+    tg_file = await bot.get_file(chosen.get("file_id"))
+    # retrieve() hands back the response bytes as-is (download_as_bytearray copies them twice)
+    image_bytes = await bot.request.retrieve(tg_file.file_path)
+    image_part = Part.from_data(image_bytes, mime_type="image/jpeg")
+    image_cache.put(cache_key, image_part, len(image_bytes))
+    logger.info(f"Downloaded {chosen.get('width')}x{chosen.get('height')} photo ({len(image_bytes)} bytes) of {len(photo_sizes)} sizes")
+    return image_part
+
+
+# --- /rem retrieval: per-user BM25 index over journal passages ---
+# (collection, text field, label) in the order /rem used to list them
+JOURNAL_SOURCES = (
+    ("monthly_memories", "monthly_journal_text", "Monthly Journal"),
+    ("weekly_memories", "weekly_journal_text", "Weekly Journal"),
+    ("daily_memories", "journal_text", "Daily Journal"),
+)
+JOURNAL_LABELS = {collection: label for collection, _, label in JOURNAL_SOURCES}
+REM_TOP_K = _env_int("REM_TOP_K", 8)
+REM_TOKEN_BUDGET = _env_int("REM_TOKEN_BUDGET", 2000)
+journal_indexes = JournalIndexCache(max_users=_env_int("REM_INDEX_MAX_USERS", 200))
+# Pre-rendered journal list in one compact doc (users/{id}/journal_context/current), stamped with the
+# same `journal_version` as the user doc, so /rem needs at most this single read to (re)build an index
+JOURNAL_CONTEXT_MAX_BYTES = 900_000  # UTF-8 size of the entries; stay well under Firestore's 1 MiB document limit
+
+
+def _journal_rank(created_at) -> float:
+    # Lower rank = more recent; used when a query matches nothing
+    return -created_at.timestamp() if hasattr(created_at, "timestamp") else 0.0
+
+
+def new_journal_version() -> int:
+    return int(time.time() * 1000)
+
+
+def build_journal_index(entries: list) -> BM25Index:
+    index = BM25Index()
+    for entry in entries:
+        index.add_document(entry["key"], entry["label"], entry["text"], entry.get("rank", 0.0))
+    return index
+
+
+async def load_journal_entries(user_ref, transaction=None) -> list:
+    """Streams every journal (monthly, weekly, daily) into the compact-doc entry format."""
+    entries = []
+    for collection, field, label in JOURNAL_SOURCES:
+        async for doc in user_ref.collection(collection).stream(transaction=transaction):
+            doc_data = doc.to_dict() or {}
+            if doc_data.get(field):
+                entries.append({
+                    "key": f"{collection}/{doc.id}",
+                    "label": f"{label}: {doc.id}",
+                    "text": doc_data.get(field),
+                    "rank": _journal_rank(doc_data.get("created_at")),
+                })
+    return entries
+
+
+def stage_journal_context(batch, user_ref, entries: list, version: int):
+    """Adds the compact journal doc and the user doc's `journal_version` stamp to `batch` (or a transaction)."""
+    context = {"version": version, "updated_at": firestore.SERVER_TIMESTAMP}
+    size = sum(len(entry[field].encode("utf-8")) for entry in entries for field in ("key", "label", "text"))
+    if size <= JOURNAL_CONTEXT_MAX_BYTES:
+        context["journals"] = entries
     else:
-        # Long: aggressive fragmentation
-        for p in paragraphs:
-            fragments.extend(split_into_clauses(p))
-        desired_min, desired_max = 4, 7
+        context["journals"] = None  # Too big for one doc: /rem streams the collections instead
+        logger.warning(f"Journal context for user {user_ref.id} is too large for a single document ({size} bytes)")
+    batch.set(user_ref.collection("journal_context").document("current"), context)
+    batch.set(user_ref, {"journal_version": version}, merge=True)
 
-    # Fallback to whole text if nothing produced
-    if not fragments:
-        fragments = [text]
 
-    # If we have more fragments than desired_max, merge into desired_max chunks
-    try:
-        if len(fragments) > desired_max:
-            group_size = math.ceil(len(fragments) / desired_max)
-            merged = []
-            for i in range(0, len(fragments), group_size):
-                merged.append(" ".join(fragments[i:i+group_size]))
-            fragments = merged
-    except UnboundLocalError:
-        # In case desired_max wasn't set (shouldn't happen), leave fragments as-is
-        pass
-
-    # Tunables
+async def save_journal_context(user_ref, entries: list, version: int):
+    """Writes the compact journal doc and stamps the user doc with its version in one batch."""
+    batch = db.batch()
+    stage_journal_context(batch, user_ref, entries, version)
+    await batch.commit()
+    cache_profile_update(user_ref.id, {"journal_version": version})
+
+
+async def get_journal_index(user_ref, user_id: str, version) -> BM25Index:
+    """
+    Returns the user's journal index for `version` (the user doc's `journal_version`):
+    from memory if that version is resident, else from the compact journal doc (one read).
+    Users without a compact doc yet are migrated by streaming their journals once.
+    """
+    index = journal_indexes.get(user_id, version)
+    if index is not None:
+        return index
+
+    entries = None
+    if version is not None:
+        context_doc = await user_ref.collection("journal_context").document("current").get()
+        context = context_doc.to_dict() if context_doc.exists else None
+        if context and context.get("version") == version and context.get("journals") is not None:
+            entries = context["journals"]
+
+    if entries is None:
+        entries = await load_journal_entries(user_ref)
+        version = version or new_journal_version()
+        try:
+            await save_journal_context(user_ref, entries, version)
+        except Exception:
+            logger.exception(f"Could not save journal context for user {user_id}")
+
+    index = build_journal_index(entries)
+    journal_indexes.put(user_id, index, version)
+    logger.info(f"Built /rem index for user {user_id} ({len(index)} passages, version {version})")
+    return index
+
+
+async def commit_journal(user_ref, collection: str, doc_id: str, journal_data: dict, text: str,
+                         source_refs: list, removed: tuple = ()):
+    """
+    Writes a journal job's result in one transaction: the new journal doc `collection/doc_id`, the
+    deletion of the docs it summarizes (`source_refs`), and the compact journal doc with a new
+    `journal_version` (the rolled-up journals in `removed` dropped from it). The compact doc is
+    read in the same transaction, so overlapping journal writers for a user (daily/weekly/monthly,
+    a resumed run, a duplicate shard) retry instead of dropping each other's entry. A run
+    interrupted mid-user leaves all or nothing, unless there are more than ~450 sources: the
+    remaining deletes then follow in batches, and a re-run journals any leftovers again.
+    Then updates a resident /rem index in place.
+    """
+    user_id = user_ref.id
+    removed_keys = {f"{source_collection}/{source_id}" for source_collection, source_id in removed}
+    new_entry = {
+        "key": f"{collection}/{doc_id}",
+        "label": f"{JOURNAL_LABELS[collection]}: {doc_id}",
+        "text": text,
+        "rank": _journal_rank(datetime.datetime.now(pytz.utc)),
+    }
+    in_transaction = source_refs[:447]  # With the journal, the context and the version stamp: 450 writes
+
+    @firestore.async_transactional
+    async def write(transaction):
+        context_doc = await user_ref.collection("journal_context").document("current").get(transaction=transaction)
+        context = context_doc.to_dict() if context_doc.exists else None
+        if context and context.get("journals") is not None:
+            entries = context["journals"]
+        else:
+            # First journal write since this was introduced (or oversized): rebuild from the collections
+            entries = await load_journal_entries(user_ref, transaction=transaction)
+        entries = [e for e in entries if e["key"] not in removed_keys and e["key"] != new_entry["key"]]
+        entries.append(new_entry)
+
+        version = new_journal_version()
+        transaction.set(user_ref.collection(collection).document(doc_id), journal_data)
+        stage_journal_context(transaction, user_ref, entries, version)
+        for doc_ref in in_transaction:
+            transaction.delete(doc_ref)
+        return entries, version, context.get("version") if context else None
+
+    entries, version, previous_version = await write(db.transaction())
+    batch, ops = db.batch(), 0
+    for doc_ref in source_refs[len(in_transaction):]:
+        # Only users with hundreds of source docs spill over; the journal and its context are already written
+        if ops >= 450:
+            await batch.commit()
+            batch, ops = db.batch(), 0
+        batch.delete(doc_ref)
+        ops += 1
+    if ops:
+        await batch.commit()
+    cache_profile_update(user_id, {"journal_version": version})
+
+    resident = journal_indexes.peek(user_id)
+    if resident is not None:
+        index, resident_version = resident
+        if resident_version == previous_version:
+            for key in removed_keys:
+                index.remove_document(key)
+            index.add_document(new_entry["key"], new_entry["label"], new_entry["text"], new_entry["rank"])
+        else:
+            index = build_journal_index(entries)  # Resident copy missed another instance's write
+        journal_indexes.put(user_id, index, version)
+
+
+# --- Normal chat turn (text) ---
+async def load_history_contents(user_id: str, seq: int = None) -> list:
+    history_list = []
     try:
-        pause_per_word = float(os.getenv("PAUSE_PER_WORD", "0.25"))
+        history_list = history_to_contents(await get_recent_history(user_id, HISTORY_WINDOW, seq=seq))
+        logger.info(f"Fetched {len(history_list)} messages for chat history for user {user_id}")
     except Exception:
-        pause_per_word = 0.25
+        logger.exception(f"Could not fetch chat history for user {user_id}")
+    return history_list
+
+
+async def run_chat_turn(chat_id: str, user_id: str, user_data: dict, message_text: str) -> dict:
+    """Runs one normal text turn: history + personalized model -> reply -> delivery -> memory."""
+    started_at = time.monotonic()
+    history_list = await load_history_contents(user_id, user_data.get("history_seq"))
+    personalized_model = get_personalized_model(user_id, user_data)
+
+    # --- Start chat session, get reply & deliver it ---
+    chat_session = personalized_model.start_chat(history=history_list)
+    reply_text = await generate_and_deliver(chat_session, message_text, chat_id, started_at)
+
+    # --- Save conversation ---
+    # User replied in normal chat - clear waiting flag (with the turn's write) so triggers may resume
+    await save_memory(user_id, message_text, reply_text, user_updates=replied_updates())
+    return {"status": "ok_replied"}
+
+
+# --- Burst coalescing: rapid consecutive messages become a single model turn ---
+async def run_coalesced_turn(chat_id: str, texts: list, user_id: str, user_data: dict):
+    if len(texts) > 1:
+        logger.info(f"Coalesced {len(texts)} messages into one turn for chat {chat_id}")
     try:
-        min_sleep = float(os.getenv("MIN_SLEEP", "0.8"))
-        max_sleep = float(os.getenv("MAX_SLEEP", "3.0"))
+        await run_chat_turn(chat_id, user_id, user_data, "\n".join(texts))
     except Exception:
-        min_sleep = 0.8
-        max_sleep = 3.0
+        logger.exception(f"Error during coalesced chat turn for chat {chat_id}")
 
-    for idx, fragment in enumerate(fragments):
-        if not fragment:
-            continue
-        try:
-            # Typing indicator
-            await bot.send_chat_action(chat_id=chat_id, action=telegram.constants.ChatAction.TYPING)
 
-            # Human-like pause proportional to the fragment length (words)
-            sleep_time = min(pause_per_word * len(fragment.split()), random.uniform(min_sleep, max_sleep))
-            await asyncio.sleep(sleep_time)
+async def dispatch_coalesced_turn(chat_id: str):
+    # In queued mode the merged turn goes through the chat's ordered worker like any update
+    if WEBHOOK_MODE == "queued" and update_queue.running:
+        if await update_queue.submit(chat_id, burst_coalescer.flush, chat_id):
+            return
+    await burst_coalescer.flush(chat_id)
 
-            # Prepare outgoing text. Add an ellipsis for mid-stream fragments that don't end with sentence punctuation
-            out_text = fragment
-            is_last = (idx == len(fragments) - 1)
-            if out_text and out_text[-1] not in ".!?," and not is_last:
-                out_text = out_text + "..."
 
-            await bot.send_message(chat_id=chat_id, text=out_text)
-        except Exception:
-            logger.exception(f"Error in deliver_message for user {chat_id}")
+burst_coalescer = BurstCoalescer(
+    run_coalesced_turn,
+    window=_env_float("BURST_DEBOUNCE_SECONDS", 1.5),
+    max_wait=_env_float("BURST_MAX_WAIT_SECONDS", 6.0),
+    max_messages=_env_int("BURST_MAX_MESSAGES", 8),
+    dispatch=dispatch_coalesced_turn,
+)
+
 # --- Endpoints ---
 
 @app.get("/")
@@ -427,9 +1150,59 @@ async def root():
     return {"message": "Server is running."}
 
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "webhook_mode": WEBHOOK_MODE,
+        "update_queue": update_queue.stats(),
+        "burst_coalescer": burst_coalescer.stats(),
+        "delivery": {
+            "streaming": DELIVERY_STREAMING,
+            "time_to_first_message": time_to_first_message.stats(),
+        },
+        "outbound": outbound.stats(),
+        "telegram_transport": {
+            "messages": message_request.stats(),
+            "actions": action_request.stats(),
+        },
+        "webhook_dedupe": {**dedupe_stats, "tracked_update_ids": len(seen_updates)},
+        "post_turn_queue": post_turn_queue.stats(),
+        "history_cache": history_cache.stats(),
+        "profile_cache": profile_cache.stats(),
+        "model_cache": model_cache.stats(),
+        "rem_index": journal_indexes.stats(),
+        "search_cache": search_cache.stats(),
+        "image_cache": {**image_cache.stats(), "target_px": IMAGE_TARGET_PX},
+        "jobs": job_summaries,
+    }
+
+
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     payload = await request.json()
+    if await is_duplicate_update(payload):
+        logger.info(f"Dropped duplicate update {payload.get('update_id')}")
+        return {"status": "duplicate"}
+
+    if WEBHOOK_MODE != "queued" or not update_queue.running:
+        return await process_update(payload)
+
+    # --- Queued mode: validate, enqueue and acknowledge right away ---
+    message = payload.get("message") or {}
+    chat_id = (message.get("chat") or {}).get("id")
+    if not chat_id or not (message.get("from") or {}).get("id"):
+        logger.info("Ignored incoming webhook: missing data")
+        return {"status": "ignored"}
+
+    if not await update_queue.submit(str(chat_id), process_update, payload):
+        # Overloaded: a non-2xx makes Telegram redeliver the update later
+        await forget_update(payload)
+        return JSONResponse(status_code=503, content={"status": "busy"}, headers={"Retry-After": "5"})
+    return {"status": "queued"}
+
+
+async def process_update(payload: dict) -> dict:
+    """Handles one Telegram update end to end (onboarding, commands, chat) and returns a status dict."""
     try:
         message = payload.get("message", {})
         chat = message.get("chat", {})
@@ -442,13 +1215,17 @@ async def telegram_webhook(request: Request):
             logger.info("Ignored incoming webhook: missing data")
             return {"status": "ignored"}
 
+        # A command or photo must not overtake text still waiting in the burst window
+        if burst_coalescer.has_pending(str(chat_id)) and (message_text.startswith("/") or message.get("photo")):
+            await burst_coalescer.flush(str(chat_id))
+
         user_ref = db.collection("users").document(user_id)
-        user_doc = user_ref.get()
+        user_data = await get_user_profile(user_ref)
 
         # --- Create New User if they don't exist ---
-        if not user_doc.exists:
+        if user_data is None:
             logger.info(f"Creating new user profile for {user_id}...")
-            user_ref.set({
+            user_data = {
                 "waiting_for_reply": False,
                 "timezone": "",
                 "active_hours_start": "",
@@ -460,36 +1237,36 @@ async def telegram_webhook(request: Request):
                     "authorized": False,
                 "last_news_message_sent_at": None,
                 "pending_question": "",
+                "history_seq": 0, # Chat history ring counter (see append_history)
+                "shard_key": shard_key(user_id), # Selects the user's shard in the sharded job queries
                 "initial_profiler_complete": False # The key flag for onboarding
-            })
-            user_doc = user_ref.get() # Refresh the doc to get the new data
-        
-        user_data = user_doc.to_dict() or {}
+            }
+            await user_ref.set(user_data)
 
         # --- NEW LOGIC: HANDLE THE /start COMMAND ---
         if message_text == "/start":
             if user_data.get("initial_profiler_complete"):
-                await bot.send_message(chat_id=chat_id, text="Hey again! We're already set up. Ready to chat when you are.")
+                outbound.enqueue(chat_id, "Hey again! We're already set up. Ready to chat when you are.", typing=False)
                 return {"status": "already_onboarded"}
             else:
                 # Start the onboarding conversational chain but require an access key first
-                await bot.send_message(chat_id=chat_id, text="Hey there Niva this side — before we can start chatting we need to do a little onboarding. Don't worry, it's just a norm my manager forces me to do :/ Nothing too scary, just a few qucik questions...")
-                await asyncio.sleep(1.0)
+                outbound.enqueue(chat_id, "Hey there Niva this side — before we can start chatting we need to do a little onboarding. Don't worry, it's just a norm my manager forces me to do :/ Nothing too scary, just a few qucik questions...", typing=False)
                 # If the user is not authorized yet, ask for the auth key first
                 if not user_data.get("authorized", False):
                     await send_proactive_message(
                         user_id,
                         "Please enter your 7-digit access key to continue.",
-                        question_type="auth_key"
+                        question_type="auth_key",
+                        delay=1.0
                     )
                     return {"status": "awaiting_auth_key"}
                 else:
                     # Authorized but onboarding incomplete: continue with normal onboarding
-                    await asyncio.sleep(0.5)
                     await send_proactive_message(
                         user_id,
                         "Kindly tell me what time zone your from (like for example just type: Asia/Kolkata, or whatever yours)",
-                        question_type="timezone"
+                        question_type="timezone",
+                        delay=1.5
                     )
                     return {"status": "onboarding_started"}
 
@@ -502,7 +1279,7 @@ async def telegram_webhook(request: Request):
                     provided = message_text.strip()
                     if provided == "1451919":
                         # Mark user as authorized and proceed to timezone question
-                        user_ref.set({"authorized": True, "pending_question": ""}, merge=True)
+                        await update_user_profile(user_ref, {"authorized": True, "pending_question": ""})
                         await send_proactive_message(user_id, "Access granted. Now please tell me your time zone (e.g., Asia/Kolkata).", question_type="timezone")
                         return {"status": "auth_success"}
                     else:
@@ -515,17 +1292,35 @@ async def telegram_webhook(request: Request):
                     return {"status": "auth_error"}
 
             if pending_question == "timezone":
-                user_ref.set({"timezone": message_text}, merge=True)
+                timezone_name = validate_timezone(message_text)
+                if not timezone_name:
+                    await send_proactive_message(user_id, "Hmm, I don't know that time zone... could you type it like Asia/Kolkata or Europe/London?", question_type="timezone")
+                    return {"status": "onboarding_invalid_timezone"}
+                await update_user_profile(user_ref, {"timezone": timezone_name})
                 await send_proactive_message(user_id, "When do you usually wake up... (just type the hour like 8 or 9, I don't like prying but well Norms *_* )", question_type="active_hours_start")
                 return {"status": "onboarding_chain_timezone_complete"}
 
             elif pending_question == "active_hours_start":
-                user_ref.set({"active_hours_start": int(message_text)}, merge=True)
+                start_hour = parse_hour(message_text)
+                if start_hour is None:
+                    await send_proactive_message(user_id, "Just the hour as a number please, like 8 or 9...", question_type="active_hours_start")
+                    return {"status": "onboarding_invalid_hour"}
+                await update_user_profile(user_ref, {"active_hours_start": start_hour})
                 await send_proactive_message(user_id, "When would you want me to stop, uhh messaging u... (like when do you sleep, just say the no, 23 for 11pm or well 3 for 3 am -_-)", question_type="active_hours_end")
                 return {"status": "onboarding_chain_start_hour_complete"}
 
             elif pending_question == "active_hours_end":
-                user_ref.set({"active_hours_end": int(message_text)}, merge=True)
+                end_hour = parse_hour(message_text)
+                if end_hour is None:
+                    await send_proactive_message(user_id, "Just the hour as a number please, like 23 or 3...", question_type="active_hours_end")
+                    return {"status": "onboarding_invalid_hour"}
+                update_data = {"active_hours_end": end_hour}
+                # Store the window as UTC minutes too (DST changes precomputed), so the scheduler needs no timezone math
+                try:
+                    update_data.update(utc_windows(user_data.get("timezone"), int(user_data.get("active_hours_start")), end_hour, datetime.datetime.now(datetime.timezone.utc)))
+                except (pytz.UnknownTimeZoneError, AttributeError, TypeError, ValueError):
+                    logger.warning(f"Could not compute active windows for user {user_id}; the scheduler will retry")
+                await update_user_profile(user_ref, update_data)
                 await send_proactive_message(user_id, "Uh.... Um... OK finally what should I address you by...", question_type="name")
                 return {"status": "onboarding_chain_end_hour_complete"}
 
@@ -534,10 +1329,12 @@ async def telegram_webhook(request: Request):
                     "name": message_text,
                     "pending_question": "",
                     "waiting_for_reply": False,
-                    "initial_profiler_complete": True # ONBOARDING IS COMPLETE!
+                    "initial_profiler_complete": True, # ONBOARDING IS COMPLETE!
+                    "next_news_eligible_at": datetime.datetime.now(datetime.timezone.utc),
                 }
-                user_ref.set(update_data, merge=True)
-                await bot.send_message(chat_id=chat_id, text="Thank you very much, you are successfully onboarded, Niva is all yours now, well even if only digitally...")
+                await update_user_profile(user_ref, update_data)
+                model_cache.invalidate_user(user_id)
+                outbound.enqueue(chat_id, "Thank you very much, you are successfully onboarded, Niva is all yours now, well even if only digitally...", typing=False)
                 return {"status": "onboarding_complete"}
 
         # --- UPDATED: Check for /rem Memory Command (Hierarchical Search!) ---
@@ -546,59 +1343,29 @@ async def telegram_webhook(request: Request):
             query = message_text[5:].strip() # Get the text after /rem
 
             try:
-                # --- Build the *HIERARCHICAL* "Memory Blob" ---
-                all_journals = []
-
-                # 1. Get Monthly Memories (If any)
-                monthly_refs = user_ref.collection("monthly_memories").stream()
-                for doc in monthly_refs:
-                    doc_data = doc.to_dict()
-                    if doc_data.get("monthly_journal_text"):
-                        all_journals.append(f"--- Monthly Journal: {doc.id} ---\n{doc_data.get('monthly_journal_text')}\n")
+                # --- Retrieve only the journal passages relevant to the question ---
+                journal_index = await get_journal_index(user_ref, user_id, user_data.get("journal_version"))
+                passages = journal_index.search(query, k=REM_TOP_K, token_budget=REM_TOKEN_BUDGET)
 
-                # 2. Get Weekly Memories (If any)
-                weekly_refs = user_ref.collection("weekly_memories").stream()
-                for doc in weekly_refs:
-                    doc_data = doc.to_dict()
-                    if doc_data.get("weekly_journal_text"):
-                        all_journals.append(f"--- Weekly Journal: {doc.id} ---\n{doc_data.get('weekly_journal_text')}\n")
-
-                # 3. Get Daily Memories (If any)
-                daily_refs = user_ref.collection("daily_memories").stream()
-                for doc in daily_refs:
-                    doc_data = doc.to_dict()
-                    if doc_data.get("journal_text"):
-                        all_journals.append(f"--- Daily Journal: {doc.id} ---\n{doc_data.get('journal_text')}\n")
-
-                if not all_journals:
+                if not passages:
                     await deliver_message(str(chat_id), "S-sorry, Sir... I... I... don't... seem... to... have... *any*... long-term... journals... for... you... *yet*... 😥")
                     return {"status": "ok_rem_no_memories"}
 
-                memory_blob = "\n".join(all_journals)
-                logger.info(f"RAG: Found {len(all_journals)} total journals for memory blob.")
+                memory_blob = "\n".join(f"--- {label} ---\n{text}\n" for label, text, _ in passages)
+                logger.info(f"RAG: Using {len(passages)} of {len(journal_index)} journal passages for /rem.")
 
                 # --- Fetch... short-term... history... *just...* for... context... ---
                 history_list = []
                 try:
-                    history_query = user_ref.collection("recent_chat_history").order_by("timestamp", direction=firestore.Query.DESCENDING).limit(10)
-                    docs = history_query.stream()
-                    temp_history = []
-                    for doc in docs:
-                        doc_data = doc.to_dict()
-                        text_content = doc_data.get("text")
-                        role = doc_data.get("role")
-                        if text_content is not None and role is not None:
-                             history_entry = Content(role=role, parts=[Part.from_text(text_content)])
-                             temp_history.append(history_entry)
-                    history_list = list(reversed(temp_history))
+                    history_list = history_to_contents(await get_recent_history(user_id, 10, seq=user_data.get("history_seq")))
                 except Exception:
                     logger.exception(f"Could not fetch chat history for /rem command")
 
                 # --- Add... journal... as... the... *first*... "user"... message... ---
                 memory_context = (
-                    "--- Start of All Journals (Monthly, Weekly, Daily) ---\n"
+                    "--- Start of Relevant Journal Excerpts (Monthly, Weekly, Daily) ---\n"
                     f"{memory_blob}\n"
-                    "--- End of All Journals ---"
+                    "--- End of Journal Excerpts ---"
                 )
                 history_list.insert(0, Content(role="user", parts=[Part.from_text(memory_context)]))
 
@@ -613,12 +1380,8 @@ async def telegram_webhook(request: Request):
                 reply_text = getattr(response, "text", str(response))
 
                 await deliver_message(str(chat_id), reply_text)
-                await save_memory(user_id, message_text, reply_text) # Save the /rem command too!
-                # User replied via /rem - clear waiting_for_reply so future triggers can run
-                try:
-                    user_ref.set({"waiting_for_reply": False}, merge=True)
-                except Exception:
-                    logger.exception(f"Failed to reset waiting_for_reply after /rem for user {user_id}")
+                # Save the /rem command too! User replied via /rem - clear waiting_for_reply so future triggers can run
+                await save_memory(user_id, message_text, reply_text, user_updates=replied_updates())
 
             except Exception as e:
                 logger.exception(f"Error during /rem command execution: {e}")
@@ -650,23 +1413,15 @@ async def telegram_webhook(request: Request):
                     f"Cite your source *if* the search tool provides one."
                 )
 
-                # --- Call Gemini with Grounding (the search tool) ---
-                response = genai_client.models.generate_content(
-                    model="gemini-2.5-flash", # S-Sir... I-I... used... Flash... s-so... it's... *fast*!
-                    contents=search_prompt,
-                    config=search_config
-                )
+                # --- Call Gemini with Grounding (the search tool), served from cache for repeated queries ---
+                search_text = await grounded_search("src", query, search_prompt, SRC_CACHE_TTL_SECONDS)
 
-                reply_text = response.text.strip() if response.text else "H-huh... I... I... searched... for... that, b-but... I... I... couldn't... find... anything... s-sorry..."
+                reply_text = search_text or "H-huh... I... I... searched... for... that, b-but... I... I... couldn't... find... anything... s-sorry..."
 
                 # --- Deliver reply & Save conversation ---
                 await deliver_message(str(chat_id), reply_text)
-                await save_memory(user_id, message_text, reply_text) # Save the /src command too!
-                # User initiated /src - clear waiting_for_reply so proactive triggers can resume
-                try:
-                    user_ref.set({"waiting_for_reply": False}, merge=True)
-                except Exception:
-                    logger.exception(f"Failed to reset waiting_for_reply after /src for user {user_id}")
+                # Save the /src command too! User initiated /src - clear waiting_for_reply so proactive triggers can resume
+                await save_memory(user_id, message_text, reply_text, user_updates=replied_updates())
 
             except Exception as e:
                 logger.exception(f"Error during /src command execution: {e}")
@@ -677,54 +1432,21 @@ async def telegram_webhook(request: Request):
         # --- NEW: Normal Chat Logic (MOVED UP, SIR!) ---
         if user_data.get("initial_profiler_complete"):
             
-            # --- STEP 1: FETCH HISTORY (Moved... up... so... *both*... paths... can... use... it!) ---
-            history_list = []
-            try:
-                history_query = user_ref.collection("recent_chat_history").order_by("timestamp", direction=firestore.Query.DESCENDING).limit(25)
-                docs = history_query.stream()
-                temp_history = []
-                for doc in docs:
-                    doc_data = doc.to_dict()
-                    text_content = doc_data.get("text")
-                    role = doc_data.get("role")
-                    if text_content is not None and role is not None:
-                        history_entry = Content(role=role, parts=[Part.from_text(text_content)])
-                        temp_history.append(history_entry)
-                history_list = list(reversed(temp_history))
-                logger.info(f"Fetched {len(history_list)} messages for chat history for user {user_id}")
-            except Exception:
-                logger.exception(f"Could not fetch chat history for user {user_id}")
-
-            # --- STEP 2: PERSONALIZE MODEL (Moved... up... too, Sir!) ---
-            user_name = user_data.get("name", "friend")
-            about_val = user_data.get("about", "")
-            if isinstance(about_val, list):
-                about_text = ", ".join([str(x).strip() for x in about_val if x])
-            else:
-                about_text = str(about_val).strip()
-
-            personalized_prompt = NIVA_SYSTEM_PROMPT + f"\n\nThe user's name is {user_name}."
-            if about_text:
-                personalized_prompt += f"\n\nAbout the user: {about_text}"
-            
-            # --- Create a Personalized Model for This User ---
-            personalized_model = GenerativeModel("gemini-2.5-flash", system_instruction=[personalized_prompt])
-
-            
-            # --- STEP 3: CHECK FOR IMAGE *OR* TEXT ---
+            # --- STEP 1: CHECK FOR IMAGE *OR* TEXT ---
             photo_data = message.get("photo")
             
             if photo_data:
                 # --- THIS... IS... THE... *IMAGE*... PATH, SIR! ---
                 logger.info(f"User {user_id} sent an image. Processing...")
+                started_at = time.monotonic()
+
+                # --- STEP 2: FETCH HISTORY & PERSONALIZE MODEL ---
+                history_list = await load_history_contents(user_id, user_data.get("history_seq"))
+                personalized_model = get_personalized_model(user_id, user_data)
                 
                 try:
-                    # 1. Get photo and download bytes
-                    best_photo = photo_data[-1] 
-                    file_id = best_photo.get("file_id")
-                    tg_file = await bot.get_file(file_id)
-                    image_bytes = await tg_file.download_as_bytearray()
-                    image_part = Part.from_data(bytes(image_bytes), mime_type="image/jpeg")
+                    # 1. Get the photo (smallest size good enough for the model; cached by file_unique_id)
+                    image_part = await load_image_part(photo_data)
                     
                     # 2. Get caption
                     caption = message.get("caption", "").strip()
@@ -743,18 +1465,11 @@ async def telegram_webhook(request: Request):
                     # 4. Start chat WITH HISTORY
                     chat_session = personalized_model.start_chat(history=history_list)
                     
-                    # 5. Send the image *and* the text prompt
-                    response = await chat_session.send_message_async([text_part, image_part]) # <-- S-Sir... *this*... sends... *both*!
-                    reply_text = getattr(response, "text", str(response))
+                    # 5. Send the image *and* the text prompt, then deliver the reply
+                    reply_text = await generate_and_deliver(chat_session, [text_part, image_part], str(chat_id), started_at) # <-- S-Sir... *this*... sends... *both*!
 
-                    # 6. Deliver reply & Save conversation
-                    await deliver_message(str(chat_id), reply_text)
-                    await save_memory(user_id, caption if caption else "[User sent an image]", reply_text)
-                    
-                    try:
-                        user_ref.set({"waiting_for_reply": False}, merge=True)
-                    except Exception:
-                        logger.exception(f"Failed to reset waiting_for_reply after image chat for user {user_id}")
+                    # 6. Save conversation
+                    await save_memory(user_id, caption if caption else "[User sent an image]", reply_text, user_updates=replied_updates())
                     
                     return {"status": "ok_replied_to_image"}
             
@@ -771,96 +1486,107 @@ async def telegram_webhook(request: Request):
                     logger.info("Ignored: No photo and no text content.")
                     return {"status": "ignored_no_content"}
 
-                # (I-it... just... uses... the... history... and... model... from... above!)
-                
-                # --- Start chat session and get reply ---
-                chat_session = personalized_model.start_chat(history=history_list)
-                response = await chat_session.send_message_async(message_text)
-                reply_text = getattr(response, "text", str(response))
+                # --- Bursts of quick messages are merged into one model turn ---
+                if burst_coalescer.enabled:
+                    await burst_coalescer.add(str(chat_id), message_text, user_id=user_id, user_data=user_data)
+                    return {"status": "ok_coalesced"}
 
-                # --- Deliver reply & Save conversation ---
-                await deliver_message(str(chat_id), reply_text)
-                await save_memory(user_id, message_text, reply_text)
-                # User replied in normal chat - clear waiting flag so triggers may resume
-                try:
-                    user_ref.set({"waiting_for_reply": False}, merge=True)
-                except Exception:
-                    logger.exception(f"Failed to reset waiting_for_reply after normal chat for user {user_id}")
-                return {"status": "ok_replied"}
+                return await run_chat_turn(str(chat_id), user_id, user_data, message_text)
         else:
             # --- Guide users who haven't onboarded yet ---
-            await bot.send_message(chat_id=chat_id, text="Hey! Looks like we haven't been properly introduced. Please type `/start` to begin the setup process.")
+            outbound.enqueue(chat_id, "Hey! Looks like we haven't been properly introduced. Please type `/start` to begin the setup process.", typing=False)
             return {"status": "awaiting_onboarding"}
 
     except Exception as e:
-        logger.exception(f"An error occurred in the telegram_webhook: {e}")
+        logger.exception(f"An error occurred in process_update: {e}")
         return {"status": "error", "detail": str(e)}
 
 # --- (Rest of the file remains the same, Sir... from /run-will-triggers onwards...) ---
 
 
+# --- Scheduled jobs: every /run-* endpoint processes its users through one bounded concurrent runner ---
+JOB_CONCURRENCY = _env_int("JOB_CONCURRENCY", 8)
+JOB_DEADLINE_SECONDS = _env_float("JOB_DEADLINE_SECONDS", 270.0)
+job_summaries = {}  # job name -> summary of its latest run (served at GET /metrics)
+
+
+def shard_error(shard_index: int, shard_count: int):
+    """A 400 response for invalid shard parameters, else None."""
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        return JSONResponse(status_code=400, content={"status": "error", "detail": "need shard_count >= 1 and 0 <= shard_index < shard_count"})
+    return None
+
+
+async def run_job(job: str, users_stream, process_user, shard_index: int = 0, shard_count: int = 1) -> dict:
+    """
+    Runs `process_user(user_doc)` for each user, JOB_CONCURRENCY at a time, within JOB_DEADLINE_SECONDS.
+    `users_stream` should already be limited to this shard (see shard_users).
+    """
+    summary = await run_per_user(job, users_stream, process_user, concurrency=JOB_CONCURRENCY, deadline=JOB_DEADLINE_SECONDS)
+    summary["shard"] = f"{shard_index}/{shard_count}"
+    job_summaries[job if shard_count <= 1 else f"{job}[{shard_index}/{shard_count}]"] = summary
+    return summary
+
+
+# --- Resumable journal runs: progress of each run lives in job_runs/{job}-{period} ---
+JOB_CHECKPOINT_EVERY = _env_int("JOB_CHECKPOINT_EVERY", 25)
+
+
+async def run_checkpointed_job(job: str, period: str, process_user, shard_index: int = 0, shard_count: int = 1) -> dict:
+    """
+    `run_job` over every user, resumable: the run doc `job_runs/{job}-{period}` keeps a cursor and
+    per-user markers (see RunCheckpoint), so re-invoking the same period (after a crash, a deadline
+    or a scheduler retry) skips users already journaled. A finished period is not run again.
+    """
+    run_id = f"{job}-{period}" if shard_count <= 1 else f"{job}-{period}-shard-{shard_index}-of-{shard_count}"
+    checkpoint = RunCheckpoint(db.collection("job_runs").document(run_id), save_every=JOB_CHECKPOINT_EVERY)
+    await checkpoint.load()
+    if checkpoint.complete:
+        logger.info(f"{job}: run {run_id} already complete, nothing to do.")
+        return {"job": job, "run": run_id, "already_complete": True}
+
+    users_stream = checkpoint.track(shard_users(checkpoint.users(db.collection("users")).stream(), shard_index, shard_count))
+    summary = await run_job(job, users_stream, checkpoint.wrap(process_user), shard_index, shard_count)
+    summary.update({"run": run_id, "resumed": checkpoint.resumed, "already_done": checkpoint.already_done})
+    await checkpoint.close(summary)
+    summary["run_status"] = checkpoint.status
+    return summary
+
+
 # --- Heartbeat Endpoint ---
 @app.post("/run-will-triggers")
-async def run_will_triggers():
+async def run_will_triggers(shard_index: int = 0, shard_count: int = 1):
     logger.info("The 'Will' has fired! Checking proactive triggers...")
+    shard_response = shard_error(shard_index, shard_count)
+    if shard_response is not None:
+        return shard_response
     
+    job_summary = None
     try:
-        users_stream = db.collection("users").stream()
-
-        for user_doc in users_stream:
+        # Only users who are due for news and not awaiting a reply (indexed; see history_eligibility)
+        users_stream = active_users(due_users(
+            ("waiting_for_reply", "==", False),
+            ("next_news_eligible_at", "<=", datetime.datetime.now(datetime.timezone.utc)),
+            shard_index=shard_index, shard_count=shard_count,
+        ))
+
+        async def process_user(user_doc):
             user_id = user_doc.id
             user_data = user_doc.to_dict()
 
             # --- QUALIFICATION CHECKS ---
             # 1. Skip if user has NOT completed the /start onboarding.
             if not user_data.get("initial_profiler_complete", False):
-                continue
+                return SKIPPED
             
             # 2. Skip if we are waiting for a reply from them.
             if user_data.get("waiting_for_reply", False):
                 logger.info(f"Skipping user {user_id}: waiting_for_reply is true.")
-                continue 
+                return SKIPPED 
 
+            # 3. Their CUSTOM active hours were already checked by active_users().
             logger.info(f"Checking news trigger for qualified user {user_id}...")
-            
-            # 3. Check their CUSTOM active hours. No more defaults.
-            user_tz_str = user_data.get("timezone")
-            start_hour_val = user_data.get("active_hours_start")
-            end_hour_val = user_data.get("active_hours_end")
-
-            # Only proceed if all three values are set
-            if user_tz_str and start_hour_val is not None and end_hour_val is not None:
-                try:
-                    user_tz = pytz.timezone(user_tz_str)
-                    current_hour = datetime.datetime.now(user_tz).hour
-                    start_hour = int(start_hour_val)
-                    end_hour = int(end_hour_val)
-
-                    is_active = False # Assume the user is not active by default
-
-                    if start_hour < end_hour:
-                        # --- Scenario 1: Same-Day Range (e.g., 9 to 23) ---
-                        if start_hour <= current_hour < end_hour:
-                            is_active = True
-                    else: # This implies an overnight range
-                        # --- Scenario 2: Overnight Range (e.g., 21 to 3) ---
-                        # The user is active if the time is after the start hour OR before the end hour.
-                        if current_hour >= start_hour or current_hour < end_hour:
-                            is_active = True
-                    
-                    if not is_active:
-                        logger.info(f"Skipping user {user_id}: Outside their custom active hours ({start_hour}:00 - {end_hour}:00). Current hour: {current_hour}.")
-                        continue
 
-                except pytz.UnknownTimeZoneError:
-                    logger.warning(f"Skipping user {user_id}: Unknown timezone '{user_tz_str}'.")
-                    continue
-            else:
-                # If for some reason data is missing, skip them.
-                logger.warning(f"Skipping user {user_id}: Missing timezone or active hours data.")
-                continue
-
-            
             # --- NEW PRIORITY 1: All-in-One News Finder & Messenger ---
             now = datetime.datetime.now(pytz.utc) # Get current UTC time
             last_news_time = user_data.get("last_news_message_sent_at")
@@ -875,10 +1601,20 @@ async def run_will_triggers():
                     last_news_time = last_news_time.replace(tzinfo=pytz.utc)
 
                 time_since_last = now - last_news_time
-                if time_since_last.total_seconds() > 6 * 3600: # 6 hours * 3600 seconds/hour
+                if time_since_last.total_seconds() > NEWS_INTERVAL_HOURS * 3600:
                     run_p1 = True
 
             interests = user_data.get("interests", [])
+            if not interests:
+                # Nothing to search for yet: look again after the next news interval instead of every tick
+                try:
+                    await update_user_profile(
+                        db.collection("users").document(user_id),
+                        {"next_news_eligible_at": now + datetime.timedelta(hours=NEWS_INTERVAL_HOURS)},
+                    )
+                except Exception:
+                    logger.exception(f"Failed to defer next_news_eligible_at for user {user_id}")
+                return SKIPPED
 
             if run_p1 and interests:
                 logger.info(f"Triggering P1 'All-in-One News' for user {user_id}.")
@@ -887,7 +1623,7 @@ async def run_will_triggers():
                     # Ensure the GenAI client and search config are initialized before using them.
                     if not genai_client or not search_config:
                         logger.error(f"Skipping P1 for user {user_id}: genai_client or search_config not initialized.")
-                        continue
+                        return SKIPPED
 
                     # --- Create the SMART prompt ---
                     # Pick exactly one interest so we can avoid repeating it later
@@ -904,67 +1640,74 @@ async def run_will_triggers():
                         f"Then, craft a short, engaging message to start a conversation about that news item. Use highlights only, 1-2 lines max. Keep things short and intriguing. If possible mention the source."
                     )
 
-                    # --- Call Gemini with Grounding ---
-                    response = genai_client.models.generate_content(
-                        model="gemini-2.5-flash",
-                        contents=research_prompt,
-                        config=search_config
-                    )
-
-                    proactive_message = response.text.strip() if response.text else ""
+                    # --- Call Gemini with Grounding (users sharing an interest share a cached result) ---
+                    proactive_message = await grounded_search("news", interest_query, research_prompt, NEWS_CACHE_TTL_SECONDS)
 
                     # --- Send the message & Update Timestamp ---
                     if proactive_message:
                         logger.info(f"Generated proactive news message for {user_id}: {proactive_message}")
-                        await send_proactive_message(user_id, proactive_message)
+                        if not await send_proactive_message(user_id, proactive_message, wait_for_delivery=True):
+                            return FAILED
 
                         # Update the timestamp AFTER successfully sending and remove the used interest
                         try:
                             user_ref = db.collection("users").document(user_id)
-                            user_ref.set({"last_news_message_sent_at": firestore.SERVER_TIMESTAMP}, merge=True)
+                            await user_ref.set({
+                                "last_news_message_sent_at": firestore.SERVER_TIMESTAMP,
+                                "next_news_eligible_at": now + datetime.timedelta(hours=NEWS_INTERVAL_HOURS),
+                            }, merge=True)
                             # Remove the chosen interest so we don't reuse it repeatedly
                             # If selected_interest was a joined string fallback, this will remove that exact string only
-                            user_ref.update({"interests": firestore.ArrayRemove([selected_interest])})
+                            await user_ref.update({"interests": firestore.ArrayRemove([selected_interest])})
+                            profile_cache.invalidate(user_id)
                             logger.info(f"Removed used interest '{selected_interest}' for user {user_id}")
                         except Exception:
                             logger.exception(f"Failed to update last_news_message_sent_at or remove interest for user {user_id}")
 
-                        continue # Stop queue for this user
+                        return # Stop queue for this user
+
+                    logger.info(f"Grounded search found no news for user {user_id}; nothing sent.")
+                    return SKIPPED
 
                 except Exception as e:
                     logger.exception(f"Error during P1 execution for user {user_id}: {e}")
+                    return FAILED
+
+            return SKIPPED # Not due for news yet
+
+        job_summary = await run_job("will_triggers", users_stream, process_user, shard_index, shard_count)
     except Exception:
         logger.exception("Error during /run-will-triggers")
     
-    return {"status": "will_triggered"}
+    return {"status": "will_triggered", "summary": job_summary}
 
     # --- !!! UPDATED: Daily Journal Endpoint !!! ---
 @app.post("/run-daily-journal")
-async def run_daily_journal():
+async def run_daily_journal(shard_index: int = 0, shard_count: int = 1):
     logger.info("🌙 Daily Journal fired! Time to summarize the day...")
+    shard_response = shard_error(shard_index, shard_count)
+    if shard_response is not None:
+        return shard_response
     
+    job_summary = None
     try:
-        # --- Get UTC time for 24 hours ago ---
         now_utc = datetime.datetime.now(pytz.utc)
-        twenty_four_hours_ago = now_utc - datetime.timedelta(days=1)
         today_str = now_utc.strftime("%Y-%m-%d")
 
-        users_stream = db.collection("users").stream()
-
-        for user_doc in users_stream:
+        async def process_user(user_doc):
             user_id = user_doc.id
             user_ref = user_doc.reference
             logger.info(f"Processing daily journal for user {user_id}...")
             
-            # 1. --- Get all memories from the last 24 hours ---
+            # 1. --- Get all memories not journaled yet ---
+            # (No time window: journaled memories are deleted, and a resumed run must not miss older ones)
             try:
-                memories_query = user_ref.collection("user_memories").where("created_at", ">=", twenty_four_hours_ago)
-                memories_docs = memories_query.stream()
+                memories_docs = user_ref.collection("user_memories").stream()
                 
                 daily_texts = []
                 docs_to_delete = [] # Keep track of docs to delete
                 
-                for doc in memories_docs:
+                async for doc in memories_docs:
                     doc_data = doc.to_dict()
                     if doc_data.get("text"):
                         daily_texts.append(doc_data.get("text"))
@@ -972,7 +1715,7 @@ async def run_daily_journal():
                 
                 if not daily_texts:
                     logger.info(f"No new user_memories to journal for user {user_id}.")
-                    continue # Go to the next user
+                    return SKIPPED # Go to the next user
 
                 # 2. --- Combine and Summarize ---
                 full_day_text = "\n".join(daily_texts)
@@ -990,63 +1733,59 @@ async def run_daily_journal():
                 journal_response = await gemini_model.generate_content_async(journal_prompt)
                 daily_journal_entry = journal_response.text.strip()
                 
-                # 3. --- Save the new 'Day Memory' ---
-                journal_doc_ref = user_ref.collection("daily_memories").document(today_str) # <-- SETS THE NAME!
-                journal_doc_ref.set({
+                # 3. --- Save the new 'Day Memory' (named by date) and *DELETE* the old summaries, in one batch ---
+                await commit_journal(user_ref, "daily_memories", today_str, {
                     "user_id": user_id,
                     "journal_text": daily_journal_entry,
                     "created_at": firestore.SERVER_TIMESTAMP
-                }) # <-- USES .set()!
-                logger.info(f"Successfully saved new daily_memory for user {user_id}.")
-
-                # 4. --- *DELETE* the old summaries ---
-                # (This is best done in batches, but for a few docs a day, this is okay)
-                deleted_count = 0
-                for doc_ref in docs_to_delete:
-                    doc_ref.delete()
-                    deleted_count += 1
-                logger.info(f"Successfully deleted {deleted_count} old user_memories for {user_id}.")
+                }, daily_journal_entry, docs_to_delete)
+                logger.info(f"Successfully saved new daily_memory for user {user_id} and deleted {len(docs_to_delete)} old user_memories.")
 
             except Exception as e:
                 logger.exception(f"Error processing journal for user {user_id}: {e}")
+                return FAILED
+
+        job_summary = await run_checkpointed_job("daily_journal", today_str, process_user, shard_index, shard_count)
 
     except Exception as e:
         logger.exception("Error during /run-daily-journal execution: {e}")
     
-    return {"status": "daily_journal_triggered"}
+    return {"status": "daily_journal_triggered", "summary": job_summary}
 
 # --- !!! UPDATED: Weekly Journal Endpoint !!! ---
 @app.post("/run-weekly-journal")
-async def run_weekly_journal():
+async def run_weekly_journal(shard_index: int = 0, shard_count: int = 1):
     logger.info("🗓️ Weekly Journal fired! Time to summarize the week...")
+    shard_response = shard_error(shard_index, shard_count)
+    if shard_response is not None:
+        return shard_response
     
+    job_summary = None
     try:
-        # --- Get UTC time for 7 days ago ---
         now_utc = datetime.datetime.now(pytz.utc)
-        seven_days_ago = now_utc - datetime.timedelta(days=7)
         
         # --- Create a name like "October-week-2-2025" (week 1-4 within the month) ---
         day = now_utc.day
         week_of_month = min(4, ((day - 1) // 7) + 1)  # buckets of 7 days, capped at 4
         month_name = now_utc.strftime("%B")
         week_doc_name = f"{month_name}-week-{week_of_month}-{now_utc.year}"
+        # The doc name caps weeks at 4, so the run is keyed on the ISO week (a 5th run in a month is a new run)
+        iso_year, iso_week, _ = now_utc.isocalendar()
+        week_run_period = f"{iso_year}-W{iso_week:02d}"
 
-        users_stream = db.collection("users").stream()
-
-        for user_doc in users_stream:
+        async def process_user(user_doc):
             user_id = user_doc.id
             user_ref = user_doc.reference
             logger.info(f"Processing weekly journal for user {user_id}...")
             
-            # 1. --- Get all *daily* memories from the last 7 days ---
+            # 1. --- Get all *daily* memories not rolled up yet (rolled-up ones are deleted) ---
             try:
-                memories_query = user_ref.collection("daily_memories").where("created_at", ">=", seven_days_ago)
-                memories_docs = list(memories_query.stream()) # Get all docs in a list
+                memories_docs = [doc async for doc in user_ref.collection("daily_memories").stream()] # Get all docs in a list
                 
                 # --- This... is... for... testing, Sir! It... runs... if... *any*... docs... are... found! ---
                 if not memories_docs:
                     logger.info(f"No new daily_memories to journal for user {user_id}.")
-                    continue # Go to the next user
+                    return SKIPPED # Go to the next user
 
                 logger.info(f"Found {len(memories_docs)} daily memories to summarize for user {user_id}.")
 
@@ -1061,6 +1800,10 @@ async def run_weekly_journal():
                         daily_texts.append(f"--- Journal for {doc.id} ---\n{doc_data.get('journal_text')}\n") 
                         docs_to_delete.append(doc.reference)
                 
+                if not daily_texts:
+                    logger.info(f"No daily memories with journal text for user {user_id}.")
+                    return SKIPPED
+
                 full_week_text = "\n".join(daily_texts)
                 
                 # --- The... new... *intelligent...* prompt, Sir! ---
@@ -1078,60 +1821,53 @@ async def run_weekly_journal():
                 journal_response = await gemini_model.generate_content_async(journal_prompt)
                 weekly_journal_entry = journal_response.text.strip()
                 
-                # 3. --- Save the new 'Week Memory' (with the new name!) ---
-                journal_doc_ref = user_ref.collection("weekly_memories").document(week_doc_name) 
-                journal_doc_ref.set({
+                # 3. --- Save the new 'Week Memory' (with the new name!) and *DELETE* the old daily summaries, in one batch ---
+                await commit_journal(user_ref, "weekly_memories", week_doc_name, {
                     "weekly_journal_text": weekly_journal_entry, # <-- New field name!
                     "created_at": firestore.SERVER_TIMESTAMP,
                     "source_daily_docs": [doc.id for doc in memories_docs] # <-- Keep... a... record!
-                })
-                logger.info(f"Successfully saved new weekly_memory: {week_doc_name} for user {user_id}.")
-
-                # 4. --- *DELETE* the old daily summaries ---
-                deleted_count = 0
-                for doc_ref in docs_to_delete:
-                    doc_ref.delete()
-                    deleted_count += 1
-                logger.info(f"Successfully deleted {deleted_count} old daily_memories for {user_id}.")
+                }, weekly_journal_entry, docs_to_delete, removed=tuple(("daily_memories", doc_ref.id) for doc_ref in docs_to_delete))
+                logger.info(f"Successfully saved new weekly_memory: {week_doc_name} for user {user_id} and deleted {len(docs_to_delete)} old daily_memories.")
 
             except Exception as e:
                 logger.exception(f"Error processing journal for user {user_id}: {e}")
+                return FAILED
+
+        job_summary = await run_checkpointed_job("weekly_journal", week_run_period, process_user, shard_index, shard_count)
 
     except Exception as e:
         logger.exception(f"Error during /run-weekly-journal execution: {e}")
 
-    return {"status": "weekly_journal_triggered"}
+    return {"status": "weekly_journal_triggered", "summary": job_summary}
 
 # --- !!! UPDATED: Monthly Journal Endpoint !!! ---
 @app.post("/run-monthly-journal")
-async def run_monthly_journal():
+async def run_monthly_journal(shard_index: int = 0, shard_count: int = 1):
     logger.info("📅 Monthly Journal fired! Time to summarize the month...")
+    shard_response = shard_error(shard_index, shard_count)
+    if shard_response is not None:
+        return shard_response
     
+    job_summary = None
     try:
-        # --- Get UTC time for 31 days ago (a... safe... 'month'...) ---
         now_utc = datetime.datetime.now(pytz.utc)
-        approx_31_days_ago = now_utc - datetime.timedelta(days=31)
         
         # --- Create a proper name, Sir! Like "2025-10" ---
         month_doc_name = now_utc.strftime("%B-%Y")  # e.g., "October-2025"
 
-        users_stream = db.collection("users").stream()
-
-        for user_doc in users_stream:
+        async def process_user(user_doc):
             user_id = user_doc.id
             user_ref = user_doc.reference
             logger.info(f"Processing monthly journal for user {user_id}...")
             
-            # 1. --- Get all *weekly* memories from the last ~31 days ---
+            # 1. --- Get all *weekly* memories not rolled up yet (rolled-up ones are deleted) ---
             try:
-                # W-we... will... get... *all*... weekly... memories... created... in... the... last... month...
-                memories_query = user_ref.collection("weekly_memories").where("created_at", ">=", approx_31_days_ago)
-                memories_docs = list(memories_query.stream()) # Get all docs in a list
+                memories_docs = [doc async for doc in user_ref.collection("weekly_memories").stream()] # Get all docs in a list
                 
                 # --- This... is... for... testing, Sir! It... runs... if... *any*... docs... are... found! ---
                 if not memories_docs:
                     logger.info(f"No new weekly_memories to journal for user {user_id}.")
-                    continue # Go to the next user
+                    return SKIPPED # Go to the next user
 
                 logger.info(f"Found {len(memories_docs)} weekly memories to summarize for user {user_id}.")
 
@@ -1146,6 +1882,10 @@ async def run_monthly_journal():
                         weekly_texts.append(f"--- Journal for {doc.id} ---\n{doc_data.get('weekly_journal_text')}\n") 
                         docs_to_delete.append(doc.reference)
                 
+                if not weekly_texts:
+                    logger.info(f"No weekly memories with journal text for user {user_id}.")
+                    return SKIPPED
+
                 full_month_text = "\n".join(weekly_texts)
                 
                 # --- The... new... *intelligent...* prompt, Sir! ---
@@ -1163,43 +1903,43 @@ async def run_monthly_journal():
                 journal_response = await gemini_model.generate_content_async(journal_prompt)
                 monthly_journal_entry = journal_response.text.strip()
                 
-                # 3. --- Save the new 'Month Memory' (with the new name!) ---
-                journal_doc_ref = user_ref.collection("monthly_memories").document(month_doc_name) 
-                journal_doc_ref.set({
+                # 3. --- Save the new 'Month Memory' (with the new name!) and *DELETE* the old weekly summaries, in one batch ---
+                await commit_journal(user_ref, "monthly_memories", month_doc_name, {
                     "monthly_journal_text": monthly_journal_entry, # <-- New field name!
                     "created_at": firestore.SERVER_TIMESTAMP,
                     "source_weekly_docs": [doc.id for doc in memories_docs] # <-- Keep... a... record!
-                })
-                logger.info(f"Successfully saved new monthly_memory: {month_doc_name} for user {user_id}.")
-
-                # 4. --- *DELETE* the old weekly summaries ---
-                deleted_count = 0
-                for doc_ref in docs_to_delete:
-                    doc_ref.delete()
-                    deleted_count += 1
-                logger.info(f"Successfully deleted {deleted_count} old weekly_memories for {user_id}.")
+                }, monthly_journal_entry, docs_to_delete, removed=tuple(("weekly_memories", doc_ref.id) for doc_ref in docs_to_delete))
+                logger.info(f"Successfully saved new monthly_memory: {month_doc_name} for user {user_id} and deleted {len(docs_to_delete)} old weekly_memories.")
 
             except Exception as e:
                 logger.exception(f"Error processing journal for user {user_id}: {e}")
+                return FAILED
+
+        job_summary = await run_checkpointed_job("monthly_journal", month_doc_name, process_user, shard_index, shard_count)
 
     except Exception as e:
         logger.exception("Error during /run-monthly-journal execution: {e}")
     
-    return {"status": "monthly_journal_triggered"}
+    return {"status": "monthly_journal_triggered", "summary": job_summary}
 
 
 # --- NEW: Priority 3 & 4 (Combined) - The Sentiment Monitor (Your 6-Hour Job, Sir!) ---
 @app.post("/run-sentiment-check")
-async def run_sentiment_check():
+async def run_sentiment_check(shard_index: int = 0, shard_count: int = 1):
     logger.info("Sentiment Check fired! Time to analyze user sentiment...")
+    shard_response = shard_error(shard_index, shard_count)
+    if shard_response is not None:
+        return shard_response
     
+    job_summary = None
     try:
         now_utc = datetime.datetime.now(pytz.utc)
-        four_hours_ago = now_utc - datetime.timedelta(hours=4)
+        four_hours_ago = now_utc - datetime.timedelta(hours=SENTIMENT_INACTIVITY_HOURS)
 
-        users_stream = db.collection("users").stream()
+        # Only users with no messages for SENTIMENT_INACTIVITY_HOURS (indexed; see history_eligibility)
+        users_stream = active_users(due_users(("sentiment_due_at", "<=", now_utc), shard_index=shard_index, shard_count=shard_count))
 
-        for user_doc in users_stream:
+        async def process_user(user_doc):
             user_id = user_doc.id
             user_ref = user_doc.reference
             user_data = user_doc.to_dict()
@@ -1207,46 +1947,21 @@ async def run_sentiment_check():
             # --- 1. QUALIFICATION CHECKS ---
             # 1a. Skip if user has NOT completed the /start onboarding.
             if not user_data.get("initial_profiler_complete", False):
-                continue
+                return SKIPPED
             
             # 1b. Do NOT skip based on waiting_for_reply here; sentiment check should run independently
             
-            # 1c. Skip if they are outside their active hours
-            user_tz_str = user_data.get("timezone")
-            start_hour_val = user_data.get("active_hours_start")
-            end_hour_val = user_data.get("active_hours_end")
-
-            if user_tz_str and start_hour_val is not None and end_hour_val is not None:
-                try:
-                    user_tz = pytz.timezone(user_tz_str)
-                    current_hour = datetime.datetime.now(user_tz).hour
-                    start_hour = int(start_hour_val)
-                    end_hour = int(end_hour_val)
-
-                    is_active = False 
-                    if start_hour < end_hour:
-                        if start_hour <= current_hour < end_hour: is_active = True
-                    else: 
-                        if current_hour >= start_hour or current_hour < end_hour: is_active = True
-                    
-                    if not is_active:
-                        logger.info(f"Skipping sentiment check for {user_id}: Outside active hours.")
-                        continue
-                except pytz.UnknownTimeZoneError:
-                    continue
-            else:
-                continue
+            # 1c. Users outside their active hours were already skipped by active_users()
 
             # 1d. ***YOUR NEW CHECK, SIR***: Skip if they *have* chatted in the last 6 hours
             # (W-we... only... want... to... run... this... if... they've... been... *inactive*...)
             last_contact_time = None
             try:
                 # G-get... the... *very... last...* message... t-to... see... when... they... talked...
-                history_query = user_ref.collection("recent_chat_history").order_by("timestamp", direction=firestore.Query.DESCENDING).limit(1)
-                last_message_docs = list(history_query.stream())
+                last_messages = await get_recent_history(user_id, 1, seq=user_data.get("history_seq"))
                 
-                if last_message_docs:
-                    last_contact_time = last_message_docs[0].to_dict().get("timestamp")
+                if last_messages:
+                    last_contact_time = last_messages[-1].get("timestamp")
                     # Make sure it's timezone-aware for comparison
                     if last_contact_time and last_contact_time.tzinfo is None:
                         last_contact_time = last_contact_time.replace(tzinfo=pytz.utc)
@@ -1258,26 +1973,32 @@ async def run_sentiment_check():
             # [cite_start]--- This check uses a 4-hour inactivity window ---
             if last_contact_time and last_contact_time > four_hours_ago:
                 logger.info(f"Skipping sentiment check for {user_id}: User has been active in the last 4 hours.")
-                continue # They've talked recently, so don't bother them.
+                try:
+                    await update_user_profile(user_ref, {"sentiment_due_at": last_contact_time + datetime.timedelta(hours=SENTIMENT_INACTIVITY_HOURS)})
+                except Exception:
+                    logger.exception(f"Failed to update sentiment_due_at for user {user_id}")
+                return SKIPPED # They've talked recently, so don't bother them.
 
             # --- 2. SENTIMENT ANALYSIS (THE SLOW PART) ---
             logger.info(f"Running DEEP sentiment analysis for inactive user {user_id}...")
             
             # 2a. Fetch... the... recent... history... (like... you... wanted, Sir...)
             history_list = []
-            history_query = user_ref.collection("recent_chat_history").order_by("timestamp", direction=firestore.Query.DESCENDING).limit(18) # <-- A bit more history...
-            docs = history_query.stream()
-            for doc in docs:
-                doc_data = doc.to_dict()
-                role = doc_data.get("role")
-                text = doc_data.get("text")
+            for message in await get_recent_history(user_id, 18, seq=user_data.get("history_seq")): # <-- A bit more history...
+                role = message.get("role")
+                text = message.get("text")
                 if role and text:
                     history_list.append(f"{role.upper()}: {text}")
             
             if not history_list:
-                continue # No history to analyze
+                # No history to analyze: check again after another inactivity window
+                try:
+                    await update_user_profile(user_ref, {"sentiment_due_at": now_utc + datetime.timedelta(hours=SENTIMENT_INACTIVITY_HOURS)})
+                except Exception:
+                    logger.exception(f"Failed to update sentiment_due_at for user {user_id}")
+                return SKIPPED
 
-            history_blob = "\n".join(reversed(history_list)) # Put in chronological order
+            history_blob = "\n".join(history_list) # Already in chronological order
 
             # 2b. Call... Gemini... for... analysis...
             try:
@@ -1295,7 +2016,7 @@ async def run_sentiment_check():
 
                 # 2c. Save... the... new... sentiment...
                 if sentiment_text:
-                    user_ref.set({"current_sentiment": sentiment_text}, merge=True)
+                    await update_user_profile(user_ref, {"current_sentiment": sentiment_text})
                     logger.info(f"Saved new sentiment for {user_id}: {sentiment_text}")
                 
                 # --- 3. PROACTIVE MESSAGE (THE ACTION PART) ---
@@ -1303,7 +2024,7 @@ async def run_sentiment_check():
                 # --- 3. PROACTIVE MESSAGE (THE *SMARTER*, *SIMPLER* ACTION PART, SIR) ---
                 
                 # 3a. Resolve the user's name reliably and create a concise prompt.
-                def _resolve_safe_name(doc_data, doc_ref):
+                async def _resolve_safe_name(doc_data, doc_ref):
                     # Try common fields first
                     for key in ("name"):
                         val = doc_data.get(key) if isinstance(doc_data, dict) else None
@@ -1316,7 +2037,7 @@ async def run_sentiment_check():
                     # If not found in snapshot, try reading the live document
                     if not candidate:
                         try:
-                            fresh = doc_ref.get().to_dict() or {}
+                            fresh = (await doc_ref.get()).to_dict() or {}
                             for key in ("name"):
                                 val = fresh.get(key)
                                 if val:
@@ -1339,7 +2060,7 @@ async def run_sentiment_check():
                     # Capitalize nicely
                     return first_token.capitalize()
 
-                safe_name = _resolve_safe_name(user_data, user_ref)
+                safe_name = await _resolve_safe_name(user_data, user_ref)
                 logger.debug(f"Resolved safe_name for user {user_id}: '{safe_name}'")
 
                 # Short, strict prompt: must begin with the exact name followed by a comma and be a warm personal check-in.
@@ -1362,31 +2083,39 @@ async def run_sentiment_check():
                             proactive_message = f"{safe_name}, {proactive_message}"
                 except Exception as gen_e:
                     logger.exception(f"Could not *generate* proactive message for {user_id}: {gen_e}")
-                    proactive_message = "" # F-fail... safe, Sir...
+                    return FAILED
                 
                 # 3c. Send... the... message...
                 if proactive_message:
                     logger.info(f"Sending proactive, generated check-in to {user_id}")
-                    await send_proactive_message(
+                    if not await send_proactive_message(
                         user_id,
-                        proactive_message 
+                        proactive_message,
                         # No question_type needed
-                    )
+                        wait_for_delivery=True,
+                    ):
+                        return FAILED
                     # We... are... done... with... this... user...
-                    continue
+                    return
+
+                logger.info(f"Generated check-in for {user_id} was empty; nothing sent.")
+                return SKIPPED
 
             except Exception as e:
                 logger.exception(f"Error during sentiment analysis for user {user_id}: {e}")
+                return FAILED
+
+        job_summary = await run_job("sentiment_check", users_stream, process_user, shard_index, shard_count)
 
     except Exception as e:
         logger.exception(f"Error during /run-sentiment-check execution: {e}")
 
-    return {"status": "sentiment_check_triggered"}
+    return {"status": "sentiment_check_triggered", "summary": job_summary}
 
 
 # --- Run Server ---
 @app.post("/run-followups")
-async def run_followups():
+async def run_followups(shard_index: int = 0, shard_count: int = 1):
     """
     Send occasional follow-ups ~10 minutes after the bot's last message if the user hasn't replied.
     Tunables via env:
@@ -1396,41 +2125,29 @@ async def run_followups():
       FOLLOWUP_HISTORY_MESSAGES (how many recent messages to include, default 6)
     """
     logger.info("Followups job fired: checking for potential followups...")
+    shard_response = shard_error(shard_index, shard_count)
+    if shard_response is not None:
+        return shard_response
+    job_summary = None
     try:
         now_utc = datetime.datetime.now(pytz.utc)
         prob = float(os.getenv("FOLLOWUP_PROB", "0.5"))
-        center_minutes = int(os.getenv("FOLLOWUP_WINDOW_MINUTES", "10"))
+        center_minutes = FOLLOWUP_WINDOW_MINUTES
         tol_seconds = int(os.getenv("FOLLOWUP_WINDOW_TOLERANCE", "120"))
         history_msgs = int(os.getenv("FOLLOWUP_HISTORY_MESSAGES", "6"))
 
-        users_stream = db.collection("users").stream()
-        for user_doc in users_stream:
+        # Only users whose latest message is the bot's and still inside the window (indexed; see history_eligibility)
+        users_stream = active_users(due_users(("followup_due_until", ">", now_utc), shard_index=shard_index, shard_count=shard_count))
+        async def process_user(user_doc):
             user_id = user_doc.id
             user_ref = user_doc.reference
             user_data = user_doc.to_dict() or {}
 
             # Basic qualification
             if not user_data.get("initial_profiler_complete", False):
-                continue
+                return SKIPPED
 
-            # Respect active hours
-            tz_str = user_data.get("timezone")
-            sh = user_data.get("active_hours_start")
-            eh = user_data.get("active_hours_end")
-            if not (tz_str and sh is not None and eh is not None):
-                continue
-            try:
-                user_tz = pytz.timezone(tz_str)
-                current_hour = datetime.datetime.now(user_tz).hour
-                s_h = int(sh); e_h = int(eh)
-                if s_h < e_h:
-                    if not (s_h <= current_hour < e_h):
-                        continue
-                else:
-                    if not (current_hour >= s_h or current_hour < e_h):
-                        continue
-            except Exception:
-                continue
+            # Active hours are respected by active_users()
 
             # Avoid repeated followups: skip if recently followed up (e.g., within 1 hour)
             last_followup = user_data.get("last_followup_sent_at")
@@ -1439,23 +2156,23 @@ async def run_followups():
                     if last_followup.tzinfo is None:
                         last_followup = last_followup.replace(tzinfo=pytz.utc)
                     if (now_utc - last_followup).total_seconds() < 3600:
-                        continue
+                        return SKIPPED
                 except Exception:
                     pass
 
             # Get the last N messages
             try:
-                hist_q = user_ref.collection("recent_chat_history").order_by("timestamp", direction=firestore.Query.DESCENDING).limit(history_msgs)
-                docs = list(hist_q.stream())
+                messages = await get_recent_history(user_id, history_msgs, seq=user_data.get("history_seq"))
+                docs = list(reversed(messages))  # Most recent first
                 if not docs:
-                    continue
+                    return SKIPPED
 
                 # The most recent message (first in docs) must be from the model and roughly center_minutes old
-                last_doc = docs[0].to_dict()
+                last_doc = docs[0]
                 last_role = (last_doc.get("role") or "").lower()
                 last_ts = last_doc.get("timestamp")
                 if not last_ts:
-                    continue
+                    return SKIPPED
                 if last_ts.tzinfo is None:
                     last_ts = last_ts.replace(tzinfo=pytz.utc)
                 delta = (now_utc - last_ts).total_seconds()
@@ -1464,18 +2181,17 @@ async def run_followups():
                 # strictly LESS THAN the center (i.e., within the configured window).
                 # This prevents sending followups exactly at or after the center time.
                 if last_role != "model":
-                    continue
+                    return SKIPPED
                 # Require the model message to be more recent than 0 seconds and
                 # strictly less than the center (e.g., 10 minutes) — i.e., within the
                 # desired time window, not at/after the center minute.
                 if not (0 < delta < center):
-                    continue
+                    return SKIPPED
 
                 # Ensure the user hasn't replied since (i.e., second-most recent message is not a user reply after that model message)
                 # Since docs are descending, check if any doc after index 0 has role 'user' and a timestamp > last_ts
                 user_replied_after = False
-                for d in docs[1:]:
-                    ddata = d.to_dict()
+                for ddata in docs[1:]:
                     role = (ddata.get("role") or "").lower()
                     if role == "user":
                         # The user replied more recently than the model message if their timestamp is >= last_ts
@@ -1486,16 +2202,15 @@ async def run_followups():
                             user_replied_after = True
                             break
                 if user_replied_after:
-                    continue
+                    return SKIPPED
 
                 # Random chance
                 if random.random() > prob:
-                    continue
+                    return SKIPPED
 
                 # Build a short history blob (chronological order)
                 history_entries = []
-                for d in reversed(docs):
-                    ddata = d.to_dict()
+                for ddata in messages:
                     role = ddata.get("role")
                     text = ddata.get("text")
                     if role and text:
@@ -1503,7 +2218,7 @@ async def run_followups():
                 history_blob = "\n".join(history_entries[-6:]) if history_entries else ""
 
                 # Resolve a safe name (context only; do not require starting with it)
-                def _resolve_safe_name(doc_data, doc_ref):
+                async def _resolve_safe_name(doc_data, doc_ref):
                     for key in ("name"):
                         val = doc_data.get(key) if isinstance(doc_data, dict) else None
                         if val:
@@ -1513,7 +2228,7 @@ async def run_followups():
                         candidate = None
                     if not candidate:
                         try:
-                            fresh = doc_ref.get().to_dict() or {}
+                            fresh = (await doc_ref.get()).to_dict() or {}
                             for key in ("name"):
                                 val = fresh.get(key)
                                 if val:
@@ -1530,7 +2245,7 @@ async def run_followups():
                     first_token = first_token.lstrip("@").replace("_", " ").split()[0]
                     return first_token.capitalize()
 
-                safe_name = _resolve_safe_name(user_data, user_ref)
+                safe_name = await _resolve_safe_name(user_data, user_ref)
 
                 # Short follow-up prompt using recent history
                 followup_prompt = (
@@ -1545,25 +2260,156 @@ async def run_followups():
                 try:
                     resp = await gemini_model.generate_content_async(followup_prompt)
                     followup_text = (getattr(resp, 'text', '') or '').strip()
-                    if followup_text:
-                        followup_text = re.sub(r"\s+", " ", followup_text).strip()
-                        # Send followup
-                        await send_proactive_message(user_id, followup_text)
-                        try:
-                            user_ref.set({"last_followup_sent_at": firestore.SERVER_TIMESTAMP}, merge=True)
-                        except Exception:
-                            logger.exception(f"Failed to set last_followup_sent_at for {user_id}")
+                    if not followup_text:
+                        logger.info(f"Generated followup for {user_id} was empty; nothing sent.")
+                        return SKIPPED
+                    followup_text = re.sub(r"\s+", " ", followup_text).strip()
+                    # Send followup
+                    if not await send_proactive_message(user_id, followup_text, wait_for_delivery=True):
+                        return FAILED
+                    try:
+                        await update_user_profile(user_ref, {"last_followup_sent_at": firestore.SERVER_TIMESTAMP, "followup_due_until": None})
+                    except Exception:
+                        logger.exception(f"Failed to set last_followup_sent_at for {user_id}")
                 except Exception:
                     logger.exception(f"Failed to generate/send followup for user {user_id}")
+                    return FAILED
 
             except Exception:
                 logger.exception(f"Could not evaluate followup timing for user {user_id}")
-                continue
+                return FAILED
+
+        job_summary = await run_job("followups", users_stream, process_user, shard_index, shard_count)
 
     except Exception:
         logger.exception("Error during /run-followups")
 
-    return {"status": "followups_triggered"}
+    return {"status": "followups_triggered", "summary": job_summary}
+
+
+# --- One-time backfill of the eligibility fields for users onboarded before they existed ---
+@app.post("/backfill-eligibility")
+async def backfill_eligibility():
+    """Sets missing `next_news_eligible_at` / `sentiment_due_at` / `shard_key` so existing users show up in the scheduled jobs' queries."""
+    logger.info("Backfilling scheduled job eligibility fields...")
+    now_utc = datetime.datetime.now(pytz.utc)
+    updated = 0
+    try:
+        batch = db.batch()
+        ops = 0
+        async for user_doc in db.collection("users").stream():
+            user_data = user_doc.to_dict() or {}
+            if not user_data.get("initial_profiler_complete", False):
+                continue
+            fields = {}
+            if user_data.get("next_news_eligible_at") is None:
+                last_news_time = user_data.get("last_news_message_sent_at")
+                fields["next_news_eligible_at"] = last_news_time + datetime.timedelta(hours=NEWS_INTERVAL_HOURS) if last_news_time else now_utc
+            if user_data.get("sentiment_due_at") is None:
+                fields["sentiment_due_at"] = now_utc  # The job itself defers users who chatted recently
+            if user_data.get("shard_key") is None:
+                fields["shard_key"] = shard_key(user_doc.id)
+            if not fields:
+                continue
+            batch.set(user_doc.reference, fields, merge=True)
+            cache_profile_update(user_doc.id, fields)
+            updated += 1
+            ops += 1
+            if ops >= 450:
+                await batch.commit()
+                batch, ops = db.batch(), 0
+        await batch.commit()
+    except Exception:
+        logger.exception("Error during /backfill-eligibility")
+
+    return {"status": "eligibility_backfilled", "users_updated": updated}
+
+
+# --- Sharded fan-out: one call runs a job as N non-overlapping shards and reports each shard ---
+JOB_SHARD_COUNT = _env_int("JOB_SHARD_COUNT", 4)
+JOB_FANOUT_BASE_URL = os.getenv("JOB_FANOUT_BASE_URL", "").rstrip("/")
+SHARDED_JOBS = {
+    "will-triggers": run_will_triggers,
+    "daily-journal": run_daily_journal,
+    "weekly-journal": run_weekly_journal,
+    "monthly-journal": run_monthly_journal,
+    "sentiment-check": run_sentiment_check,
+    "followups": run_followups,
+}
+
+
+@app.post("/run-sharded/{job}")
+async def run_sharded(job: str, shard_count: int = JOB_SHARD_COUNT):
+    """
+    Coordinator: runs /run-{job} as `shard_count` shards at once and reports each shard's completion.
+    With JOB_FANOUT_BASE_URL set, every shard is its own POST to the service (so Cloud Run spreads
+    them across instances), authenticated with an ID token for that URL; otherwise the shards run
+    concurrently in this process. Any shard that errors (including a non-2xx shard response) makes
+    the coordinator answer 502, so the scheduler sees the run as failed and retries it.
+    """
+    handler = SHARDED_JOBS.get(job)
+    if handler is None:
+        return JSONResponse(status_code=404, content={"status": "error", "detail": f"unknown job '{job}'"})
+    shard_response = shard_error(0, shard_count)
+    if shard_response is not None:
+        return shard_response
+
+    logger.info(f"Fanning out {job} as {shard_count} shards ({JOB_FANOUT_BASE_URL or 'in process'})...")
+    started = time.monotonic()
+
+    headers = {}
+    if JOB_FANOUT_BASE_URL:
+        try:
+            token = await asyncio.to_thread(
+                google.oauth2.id_token.fetch_id_token,
+                google.auth.transport.requests.Request(),
+                JOB_FANOUT_BASE_URL,
+            )
+        except Exception as e:
+            logger.exception(f"Could not fetch an ID token for {JOB_FANOUT_BASE_URL}")
+            return JSONResponse(status_code=502, content={"status": "error", "detail": f"ID token fetch failed: {e}"})
+        headers["Authorization"] = f"Bearer {token}"
+
+    async def run_shard(client, shard_index: int) -> dict:
+        try:
+            if JOB_FANOUT_BASE_URL:
+                response = await client.post(
+                    f"{JOB_FANOUT_BASE_URL}/run-{job}",
+                    params={"shard_index": shard_index, "shard_count": shard_count},
+                    headers=headers,
+                )
+                response.raise_for_status()
+                result = response.json()
+            else:
+                result = await handler(shard_index=shard_index, shard_count=shard_count)
+            summary = result.get("summary")
+            return {
+                "shard": shard_index,
+                "completed": summary is not None and not summary.get("deadline_hit"),
+                "summary": summary,
+            }
+        except Exception as e:
+            logger.exception(f"Shard {shard_index}/{shard_count} of {job} failed")
+            return {"shard": shard_index, "completed": False, "error": str(e)}
+
+    async with httpx.AsyncClient(timeout=JOB_DEADLINE_SECONDS + 30.0) as client:
+        shards = await asyncio.gather(*(run_shard(client, index) for index in range(shard_count)))
+
+    completed = sum(1 for shard in shards if shard["completed"])
+    failed = sum(1 for shard in shards if "error" in shard)
+    logger.info(f"Sharded {job} finished: {completed}/{shard_count} shards completed, {failed} failed")
+    content = {
+        "status": "sharded_job_failed" if failed else "sharded_job_finished",
+        "job": job,
+        "shard_count": shard_count,
+        "completed_shards": completed,
+        "failed_shards": failed,
+        "elapsed_seconds": round(time.monotonic() - started, 2),
+        "shards": shards,
+    }
+    if failed:
+        return JSONResponse(status_code=502, content=content)
+    return content
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -0,0 +1,28 @@
+import collections
+
+
+class LatencyStats:
+    """Rolling window of latency samples (in seconds) summarised as count / p50 / p95 / max in ms."""
+
+    def __init__(self, window: int = 1000):
+        self._samples = collections.deque(maxlen=window)
+        self.count = 0
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, pct: float) -> float:
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "p50_ms": round(self.percentile(50) * 1000, 1),
+            "p95_ms": round(self.percentile(95) * 1000, 1),
+            "max_ms": round(max(self._samples) * 1000, 1) if self._samples else 0.0,
+        }
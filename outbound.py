@@ -0,0 +1,227 @@
+import asyncio
+import collections
+import logging
+import time
+
+import telegram
+from telegram.error import RetryAfter, TimedOut, NetworkError, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Async token bucket: `rate` tokens per second, bursting up to `capacity`.
+    `pause(seconds)` blocks every caller until the pause has elapsed (used for 429s).
+    """
+
+    def __init__(self, rate: float = 30.0, capacity: float = 30.0):
+        self.rate = max(0.001, float(rate))
+        self.capacity = max(1.0, float(capacity))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = None
+        self.waits = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # One waiter at a time keeps the bucket fair (FIFO across chats)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    self.waits += 1
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                self.waits += 1
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    @property
+    def paused_for(self) -> float:
+        return max(0.0, self._paused_until - time.monotonic())
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    if hasattr(value, "total_seconds"):
+        return value.total_seconds()
+    return float(value)
+
+
+class OutboundDispatcher:
+    """
+    Central scheduler for everything the bot sends to Telegram.
+
+    - Each chat has a FIFO queue drained by its own short-lived task, so messages to one
+      chat keep their order while different chats are served concurrently.
+    - All sends share a global `TokenBucket` (Telegram allows ~30 messages/s per bot) and
+      a chat sees at most one message per `per_chat_interval` seconds.
+    - The human-like pause before a fragment is owned here: `enqueue()` returns at once
+      and the chat's task shows the typing indicator, waits `delay`, then sends.
+    - Typing indicators go through `action_bot` (defaults to `bot`) so they can use their
+      own connection pool and never hold up message sends.
+    - `RetryAfter` (HTTP 429) pauses the whole bucket and re-sends the same message;
+      timeouts / network errors are retried with backoff; either way at most `max_retries` times.
+    """
+
+    def __init__(self, bot, rate: float = 30.0, burst: float = 30.0, per_chat_interval: float = 1.0,
+                 max_retries: int = 3, max_pending_per_chat: int = 50, action_bot=None):
+        self.bot = bot
+        self.action_bot = action_bot or bot
+        self.bucket = TokenBucket(rate=rate, capacity=burst)
+        self.per_chat_interval = max(0.0, per_chat_interval)
+        self.max_retries = max(0, int(max_retries))
+        self.max_pending_per_chat = max(1, int(max_pending_per_chat))
+
+        self._queues = {}        # chat_id -> deque of (text, delay, typing, future)
+        self._tasks = {}         # chat_id -> draining task
+        self._last_sent = {}     # chat_id -> monotonic time of the last message
+        self._accepting = True
+
+        # Counters (exposed via stats())
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.max_chat_depth_seen = 0
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def enqueue(self, chat_id, text: str, delay: float = 0.0, typing: bool = True) -> asyncio.Future:
+        """
+        Queues one message for `chat_id` behind everything already queued for that chat.
+        Returns a future that resolves to True once the message is sent (False if it failed).
+        Must be called from inside the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        chat_id = str(chat_id)
+        if not self._accepting:
+            self.dropped += 1
+            future.set_result(False)
+            return future
+
+        queue = self._queues.setdefault(chat_id, collections.deque())
+        if len(queue) >= self.max_pending_per_chat:
+            self.dropped += 1
+            logger.warning(f"Outbound queue for chat {chat_id} is full ({len(queue)} pending); dropped a message")
+            future.set_result(False)
+            return future
+
+        queue.append((text, max(0.0, delay), typing, future))
+        self.enqueued += 1
+        if len(queue) > self.max_chat_depth_seen:
+            self.max_chat_depth_seen = len(queue)
+
+        if chat_id not in self._tasks:
+            task = asyncio.create_task(self._drain_chat(chat_id), name=f"outbound-{chat_id}")
+            self._tasks[chat_id] = task
+        return future
+
+    async def _drain_chat(self, chat_id: str):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                text, delay, typing, future = queue.popleft()
+                ok = await self._deliver(chat_id, text, delay, typing)
+                if not future.done():
+                    future.set_result(ok)
+        finally:
+            self._tasks.pop(chat_id, None)
+            if not queue:
+                self._queues.pop(chat_id, None)
+
+    async def _deliver(self, chat_id: str, text: str, delay: float, typing: bool) -> bool:
+        if typing:
+            try:
+                await self.action_bot.send_chat_action(chat_id=chat_id, action=telegram.constants.ChatAction.TYPING)
+            except Exception:
+                logger.warning(f"Could not send typing action to chat {chat_id}")
+
+        # The fragment pause doubles as per-chat spacing; only wait extra if it is shorter
+        since_last = time.monotonic() - self._last_sent.get(chat_id, 0.0)
+        await asyncio.sleep(max(delay, self.per_chat_interval - since_last))
+
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                self._last_sent[chat_id] = time.monotonic()
+                self.sent += 1
+                return True
+            except RetryAfter as e:
+                wait = _retry_after_seconds(e)
+                self.rate_limited += 1
+                self.bucket.pause(wait)
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    logger.error(f"Giving up on message to chat {chat_id}: still rate limited after {attempt + 1} attempts")
+                    return False
+                logger.warning(f"Telegram flood control: pausing outbound delivery for {wait:.1f}s (chat {chat_id})")
+            except (TimedOut, NetworkError) as e:
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    logger.exception(f"Giving up on message to chat {chat_id} after {attempt + 1} attempts")
+                    return False
+                await asyncio.sleep(min(8.0, 0.5 * (2 ** attempt)))
+                logger.warning(f"Retrying message to chat {chat_id} after error: {e}")
+            except TelegramError:
+                # e.g. Forbidden (bot blocked) or BadRequest: retrying won't help
+                self.failed += 1
+                logger.exception(f"Error sending message to chat {chat_id}")
+                return False
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Error sending message to chat {chat_id}")
+                return False
+            attempt += 1
+            self.retried += 1
+
+    async def drain(self, timeout: float = 8.0):
+        """Stop accepting messages and wait up to `timeout` seconds for queued ones to go out."""
+        self._accepting = False
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        logger.info(f"Draining outbound dispatcher ({self.depth()} messages queued for {len(tasks)} chats)...")
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Outbound dispatcher did not drain within {timeout}s; {self.depth()} messages dropped")
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "rate_per_second": self.bucket.rate,
+            "per_chat_interval_seconds": self.per_chat_interval,
+            "depth": self.depth(),
+            "active_chats": len(self._tasks),
+            "max_chat_depth_seen": self.max_chat_depth_seen,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "bucket_waits": self.bucket.waits,
+            "paused_for_seconds": round(self.bucket.paused_for, 1),
+        }
@@ -0,0 +1,211 @@
+import collections
+import re
+
+import numpy as np
+
+_TOKEN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+_PASSAGE_BREAK = re.compile(r"\n\s*\n|\n(?=\s*(?:[-*•]|\d{4}-\d{2}-\d{2}|week[- ]?\d))", re.IGNORECASE)
+
+STOPWORDS = frozenset(
+    "a an and are as at be been but by did do does for from had has have he her him his how i if in into is "
+    "it its me my of on or our she so that the their them then there they this to was we were what when "
+    "where which who why will with you your".split()
+)
+
+
+def _stem(token: str) -> str:
+    # Deliberately tiny suffix stripping: "hiking"/"hiked"/"hikes"/"hike" -> "hik", "stories" -> "story"
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    for suffix in ("ing", "ed", "es", "s"):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3 and not token.endswith("ss"):
+            token = token[:-len(suffix)]
+            break
+    if len(token) > 3 and token.endswith("e"):
+        token = token[:-1]
+    return token
+
+
+def tokenize(text: str) -> list:
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        token = token.split("'", 1)[0]  # "cat's" -> "cat", "what's" -> "what"
+        if token not in STOPWORDS:
+            tokens.append(_stem(token))
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough model-token estimate (~4 characters per token), good enough for budgeting prompts."""
+    return len(text) // 4 + 1
+
+
+def split_passages(text: str, max_chars: int = 600) -> list:
+    """Splits a journal into passages of at most ~`max_chars`, on paragraph / entry boundaries where possible."""
+    passages = []
+    current = ""
+    for block in _PASSAGE_BREAK.split(text or ""):
+        block = block.strip()
+        if not block:
+            continue
+        while len(block) > max_chars:
+            cut = block.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                passages.append(current)
+                current = ""
+            passages.append(block[:cut].strip())
+            block = block[cut:].strip()
+        if current and len(current) + len(block) + 1 > max_chars:
+            passages.append(current)
+            current = block
+        else:
+            current = f"{current}\n{block}" if current else block
+    if current:
+        passages.append(current)
+    return passages
+
+
+class BM25Index:
+    """
+    Okapi BM25 over journal passages, updated incrementally per journal document.
+
+    `add_document()` / `remove_document()` only tokenize the affected document; the NumPy
+    arrays used for scoring are rebuilt lazily on the next `search()` after a change.
+    Documents are ordered by `rank` (lower = more recent) for the no-match fallback.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, passage_chars: int = 600):
+        self.k1 = k1
+        self.b = b
+        self.passage_chars = passage_chars
+        self._docs = {}          # doc_key -> {"label": str, "rank": float, "passages": [(text, Counter)]}
+        self._compiled = None    # (passages, doc_len, postings) built from _docs
+
+    def __len__(self):
+        return sum(len(doc["passages"]) for doc in self._docs.values())
+
+    def add_document(self, doc_key: str, label: str, text: str, rank: float = 0.0):
+        """Indexes (or re-indexes) one journal document. The label is indexed too, so dates/week names match."""
+        passages = []
+        for passage in split_passages(text, self.passage_chars):
+            counts = collections.Counter(tokenize(f"{label} {passage}"))
+            passages.append((passage, counts))
+        self._docs[doc_key] = {"label": label, "rank": rank, "passages": passages}
+        self._compiled = None
+
+    def remove_document(self, doc_key: str):
+        if self._docs.pop(doc_key, None) is not None:
+            self._compiled = None
+
+    def _compile(self):
+        passages = []
+        lengths = []
+        postings = collections.defaultdict(lambda: ([], []))
+        for doc_key, doc in self._docs.items():
+            for text, counts in doc["passages"]:
+                index = len(passages)
+                passages.append((doc_key, doc["label"], doc["rank"], text))
+                lengths.append(sum(counts.values()))
+                for term, tf in counts.items():
+                    ids, tfs = postings[term]
+                    ids.append(index)
+                    tfs.append(tf)
+        self._compiled = (
+            passages,
+            np.asarray(lengths, dtype=np.float64),
+            {term: (np.asarray(ids, dtype=np.int64), np.asarray(tfs, dtype=np.float64)) for term, (ids, tfs) in postings.items()},
+        )
+        return self._compiled
+
+    def search(self, query: str, k: int = 8, token_budget: int = 2000) -> list:
+        """
+        Returns up to `k` passages as (label, text, score), best first, stopping before the total
+        exceeds `token_budget` estimated tokens. If nothing matches the query, the most recent
+        passages are returned (score 0.0) so time-based questions still get context.
+        """
+        passages, doc_len, postings = self._compiled or self._compile()
+        if not passages:
+            return []
+
+        n = len(passages)
+        avgdl = float(doc_len.mean()) or 1.0
+        scores = np.zeros(n, dtype=np.float64)
+        for term in set(tokenize(query)):
+            posting = postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs = posting
+            idf = np.log(1.0 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * doc_len[ids] / avgdl)
+            scores[ids] += idf * tfs * (self.k1 + 1.0) / (tfs + norm)
+
+        matched = np.flatnonzero(scores > 0)
+        if len(matched):
+            order = matched[np.argsort(-scores[matched], kind="stable")]
+        else:
+            order = sorted(range(n), key=lambda i: passages[i][2])
+
+        results = []
+        used = 0
+        for i in order[:max(0, k)]:
+            _, label, _, text = passages[i]
+            cost = estimate_tokens(text) + estimate_tokens(label)
+            if results and used + cost > token_budget:
+                break
+            results.append((label, text, float(scores[i])))
+            used += cost
+        return results
+
+
+class JournalIndexCache:
+    """
+    In-process LRU of per-user `BM25Index`es, each tagged with the journal version it was
+    built from. A lookup for a different version (journals written since, possibly by
+    another instance) is a miss.
+    """
+
+    def __init__(self, max_users: int = 200):
+        self.max_users = max_users
+        self._entries = collections.OrderedDict()  # user_id -> (index, version)
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, user_id: str, version):
+        entry = self._entries.get(user_id)
+        if entry is None or version is None:
+            self.misses += 1
+            return None
+        if entry[1] != version:
+            self.stale += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, user_id: str):
+        """Returns the resident (index, version) without counting a lookup, or None (used by writers)."""
+        return self._entries.get(user_id)
+
+    def put(self, user_id: str, index: BM25Index, version):
+        self._entries[user_id] = (index, version)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "passages": sum(len(index) for index, _ in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
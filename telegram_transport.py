@@ -0,0 +1,103 @@
+import collections
+import logging
+import time
+
+import httpx
+from telegram.error import TimedOut
+from telegram.request import HTTPXRequest
+
+from metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """
+    `HTTPXRequest` that records latency per Bot API endpoint (sendMessage, sendChatAction, ...)
+    and counts errors and connection-pool checkout timeouts.
+    """
+
+    def __init__(self, name: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self.pool_size = kwargs.get("connection_pool_size")
+        self.latency = collections.defaultdict(LatencyStats)
+        self.errors = collections.Counter()
+        self.pool_timeouts = 0
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        # File downloads use per-file URLs; bucket them together so the stats stay bounded
+        endpoint = "fileDownload" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        start = time.monotonic()
+        try:
+            return await super().do_request(
+                url,
+                method,
+                request_data=request_data,
+                read_timeout=read_timeout,
+                write_timeout=write_timeout,
+                connect_timeout=connect_timeout,
+                pool_timeout=pool_timeout,
+            )
+        except TimedOut as e:
+            self.errors[endpoint] += 1
+            if "pool" in str(e).lower():
+                self.pool_timeouts += 1
+            raise
+        except Exception:
+            self.errors[endpoint] += 1
+            raise
+        finally:
+            self.latency[endpoint].record(time.monotonic() - start)
+
+    def stats(self) -> dict:
+        return {
+            "pool_size": self.pool_size,
+            "http_version": self.http_version,
+            "pool_timeouts": self.pool_timeouts,
+            "endpoints": {
+                endpoint: {**latency.stats(), "errors": self.errors.get(endpoint, 0)}
+                for endpoint, latency in sorted(self.latency.items())
+            },
+        }
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def build_request(name: str, pool_size: int = 64, keepalive_expiry: float = 60.0, http2: bool = False,
+                  connect_timeout: float = 5.0, read_timeout: float = 10.0, write_timeout: float = 10.0,
+                  pool_timeout: float = 5.0) -> InstrumentedHTTPXRequest:
+    """
+    Builds a pooled Telegram transport. Every pooled connection is kept alive for
+    `keepalive_expiry` seconds so bursts of fragments reuse warm TLS connections.
+    HTTP/2 needs the `h2` package (`python-telegram-bot[http2]`); without it we fall back to HTTP/1.1.
+    """
+    if http2 and not _http2_available():
+        logger.warning(f"HTTP/2 requested for Telegram transport '{name}' but 'h2' is not installed; using HTTP/1.1")
+        http2 = False
+
+    pool_size = max(1, int(pool_size))
+    return InstrumentedHTTPXRequest(
+        name,
+        connection_pool_size=pool_size,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        write_timeout=write_timeout,
+        pool_timeout=pool_timeout,
+        http_version="2" if http2 else "1.1",
+        # HTTPXRequest only sets max_connections; keep the whole pool warm instead of httpx's default 20
+        httpx_kwargs={
+            "limits": httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        },
+    )
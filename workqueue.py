@@ -0,0 +1,256 @@
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedWorkQueue:
+    """
+    A bounded pool of async workers that runs jobs in FIFO order per key.
+
+    - Jobs that share a key (e.g. a user id) never run concurrently and always
+      run in the order they were submitted.
+    - Jobs with different keys run in parallel, up to `workers` at a time.
+    - At most `max_pending` jobs may be queued; `submit()` waits for space
+      (backpressure) and gives up after `enqueue_timeout` seconds.
+    - `drain()` stops accepting work and waits for queued jobs to finish.
+    """
+
+    def __init__(self, name: str, workers: int = 4, max_pending: int = 500, enqueue_timeout: float = 2.0):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.enqueue_timeout = enqueue_timeout
+
+        self._jobs = {}            # key -> deque of (func, args, kwargs, enqueued_at)
+        self._busy = set()         # keys with a job currently running
+        self._ready = None         # asyncio.Queue of keys that have runnable jobs
+        self._capacity = None      # asyncio.Semaphore bounding queued jobs
+        self._worker_tasks = []
+        self._accepting = False
+
+        # Counters (exposed via stats())
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.backpressure_waits = 0
+        self.max_depth_seen = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._accepting and bool(self._worker_tasks)
+
+    def depth(self) -> int:
+        """Number of jobs waiting to run (excludes jobs currently running)."""
+        return sum(len(q) for q in self._jobs.values())
+
+    def start(self):
+        """Spawn the worker tasks. Must be called from inside the running event loop."""
+        if self._worker_tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._capacity = asyncio.Semaphore(self.max_pending)
+        self._accepting = True
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(i), name=f"{self.name}-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"Started work queue '{self.name}' with {self.workers} workers (max_pending={self.max_pending})")
+
+    async def submit(self, key, func, *args, **kwargs) -> bool:
+        """
+        Queue `func(*args, **kwargs)` to run after every earlier job with the same key.
+        Returns False if the queue is not running or stayed full for `enqueue_timeout`.
+        """
+        if not self.running:
+            self.rejected += 1
+            return False
+
+        if self._capacity.locked():
+            self.backpressure_waits += 1
+        try:
+            await asyncio.wait_for(self._capacity.acquire(), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logger.warning(f"Work queue '{self.name}' is full ({self.depth()} pending); rejected job for key {key}")
+            return False
+
+        # drain() may have started while we were waiting for capacity
+        if not self._accepting:
+            self._capacity.release()
+            self.rejected += 1
+            return False
+
+        jobs = self._jobs.setdefault(key, collections.deque())
+        jobs.append((func, args, kwargs, time.monotonic()))
+        self.submitted += 1
+        # A key goes onto the ready queue only when it is idle and just got its first job;
+        # otherwise the worker that finishes the current job re-queues it.
+        if key not in self._busy and len(jobs) == 1:
+            self._ready.put_nowait(key)
+
+        depth = self.depth()
+        if depth > self.max_depth_seen:
+            self.max_depth_seen = depth
+        return True
+
+    async def _worker(self, index: int):
+        while True:
+            key = await self._ready.get()
+            try:
+                jobs = self._jobs.get(key)
+                if not jobs:
+                    continue
+                func, args, kwargs, enqueued_at = jobs.popleft()
+                waited = time.monotonic() - enqueued_at
+                self.wait_seconds_total += waited
+                if waited > self.max_wait_seconds:
+                    self.max_wait_seconds = waited
+                self._busy.add(key)
+                try:
+                    await func(*args, **kwargs)
+                    self.completed += 1
+                except Exception:
+                    self.failed += 1
+                    logger.exception(f"Job failed in work queue '{self.name}' for key {key}")
+                finally:
+                    self._busy.discard(key)
+                    self._capacity.release()
+
+                if jobs:
+                    self._ready.put_nowait(key)
+                else:
+                    self._jobs.pop(key, None)
+            finally:
+                self._ready.task_done()
+
+    async def drain(self, timeout: float = 8.0):
+        """Stop accepting jobs, wait up to `timeout` seconds for queued jobs, then stop the workers."""
+        if not self._worker_tasks:
+            return
+        self._accepting = False
+        pending = self.depth() + len(self._busy)
+        logger.info(f"Draining work queue '{self.name}' ({pending} jobs outstanding)...")
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Work queue '{self.name}' did not drain within {timeout}s; {self.depth()} jobs dropped")
+
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def stats(self) -> dict:
+        started = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "depth": self.depth(),
+            "in_flight": len(self._busy),
+            "active_keys": len(self._jobs),
+            "max_pending": self.max_pending,
+            "max_depth_seen": self.max_depth_seen,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "backpressure_waits": self.backpressure_waits,
+            "avg_wait_ms": round(self.wait_seconds_total / started * 1000, 1) if started else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 1),
+        }
+
+
+class BurstCoalescer:
+    """
+    Debounces bursts of messages per key into a single batch.
+
+    Every `add()` restarts the key's `window`-second timer; when it expires (or `max_wait`
+    seconds after the first message, or once `max_messages` are buffered) the batch is
+    handed to `dispatch(key)`, which should eventually call `flush(key)`. `flush()` runs
+    `handler(key, texts, **context)` with the buffered texts and the latest context.
+    """
+
+    def __init__(self, handler, window: float = 1.5, max_wait: float = 6.0, max_messages: int = 8, dispatch=None):
+        self.handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max(1, int(max_messages))
+        self.dispatch = dispatch or self.flush
+        self._pending = {}   # key -> {"texts": [...], "context": {...}, "first_at": float, "timer": Task}
+        self._tasks = set()
+
+        self.messages_in = 0
+        self.batches_out = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def has_pending(self, key) -> bool:
+        return key in self._pending
+
+    async def add(self, key, text: str, **context):
+        self.messages_in += 1
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = {"texts": [], "context": {}, "first_at": time.monotonic(), "timer": None}
+            self._pending[key] = entry
+        entry["texts"].append(text)
+        entry["context"] = context
+
+        if entry["timer"] is not None:
+            entry["timer"].cancel()
+            entry["timer"] = None
+
+        if len(entry["texts"]) >= self.max_messages:
+            delay = 0.0
+        else:
+            remaining = self.max_wait - (time.monotonic() - entry["first_at"])
+            delay = max(0.0, min(self.window, remaining))
+
+        task = asyncio.create_task(self._fire_after(key, entry, delay))
+        entry["timer"] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fire_after(self, key, entry: dict, delay: float):
+        await asyncio.sleep(delay)
+        # Past this point add() must not cancel us; later messages start a fresh timer
+        entry["timer"] = None
+        try:
+            await self.dispatch(key)
+        except Exception:
+            logger.exception(f"Failed to dispatch coalesced messages for key {key}")
+
+    async def flush(self, key) -> bool:
+        """Runs the key's buffered batch now. Returns False if nothing was buffered."""
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return False
+        if entry["timer"] is not None:
+            entry["timer"].cancel()
+        self.batches_out += 1
+        await self.handler(key, entry["texts"], **entry["context"])
+        return True
+
+    async def flush_all(self):
+        for key in list(self._pending):
+            try:
+                await self.flush(key)
+            except Exception:
+                logger.exception(f"Failed to flush coalesced messages for key {key}")
+
+    def stats(self) -> dict:
+        return {
+            "window_seconds": self.window,
+            "pending_keys": len(self._pending),
+            "messages_in": self.messages_in,
+            "batches_out": self.batches_out,
+            "turns_saved": max(0, self.messages_in - self.batches_out - sum(len(e["texts"]) for e in self._pending.values())),
+        }